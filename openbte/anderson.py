@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+import numpy as np
+from termcolor import colored, cprint
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+
+
+class Anderson(object):
+
+  #Anderson (DIIS) acceleration of the fixed point x = g(x) of the outer BTE loop. The next
+  #input combines the last anderson_depth inputs and outputs so that the linearized residual
+  #f = g(x) - x is minimal. The history is dropped when the residual grows by more than
+  #anderson_restart with respect to the previous iteration.
+  #With distributed, each rank holds a part of x and the inner products are summed over
+  #the ranks; otherwise x is the same on all ranks and the coefficients of rank 0 are used.
+
+  def __init__(self,argv,distributed=False):
+
+      self.depth   = argv.setdefault('anderson_depth',0)
+      self.beta    = argv.setdefault('anderson_beta',1.0)
+      self.restart = argv.setdefault('anderson_restart',2.0)
+      self.enabled = self.depth > 0
+      self.distributed = distributed
+      self.x = None
+      self.f = None
+      self.dX = []
+      self.dF = []
+      self.residual = None
+      self.stats = {'restarts':0}
+
+  def reduce(self,data):
+
+      if self.distributed:
+         total = np.zeros_like(data)
+         comm.Allreduce([data,MPI.DOUBLE],[total,MPI.DOUBLE],op=MPI.SUM)
+         return total
+
+      comm.Bcast([data,MPI.DOUBLE],root=0)
+      return data
+
+  def mix(self,x,g,weights=None):
+
+      #x: input of the last iteration, g: its output; weights: of the inner products
+      f = g - x
+      if self.f is not None:
+         self.dX.append(x - self.x)
+         self.dF.append(f - self.f)
+         if len(self.dF) > self.depth:
+            self.dX.pop(0); self.dF.pop(0)
+      self.x = x.copy()
+      self.f = f
+
+      k = len(self.dF)
+      w = f if weights is None else f*weights
+      dF = np.array(self.dF).reshape((k,len(f)))
+      dFw = dF if weights is None else dF*weights
+      data = self.reduce(np.concatenate(([np.dot(f,w)],np.dot(dF,w),np.dot(dF,dFw.T).ravel())))
+
+      #safeguard
+      residual = np.sqrt(data[0])
+      if self.residual is not None and residual > self.restart*self.residual and k > 0:
+         self.dX = []; self.dF = []
+         self.stats['restarts'] +=1
+         k = 0
+      self.residual = residual
+
+      x_new = x + self.beta*f
+      if k > 0:
+         gamma = np.linalg.lstsq(data[1+k:].reshape((k,k)),data[1:1+k],rcond=None)[0]
+         x_new -= np.dot(gamma,np.array(self.dX) + self.beta*dF)
+
+      return x_new
+
+  def reset_stats(self):
+
+      #history size, residual norm and restarts of the last iteration
+      stats = np.array([len(self.dF),self.residual,self.stats['restarts']],dtype=np.float64)
+      self.stats['restarts'] = 0
+      return stats
+
+
+def print_anderson(stats):
+
+        print(flush=True)
+        print('                  Anderson Diagnostics        ',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
+        print(colored(' HISTORY:          ','green') + str(int(stats[0])),flush=True)
+        print(colored(' RESIDUAL:         ','green') + '{0:.4E}'.format(stats[1]),flush=True)
+        print(colored(' RESTARTS:         ','green') + str(int(stats[2])),flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+import numpy as np
+import scipy.sparse as sp
+from termcolor import colored, cprint
+from mpi4py import MPI
+from .inner_solver import *
+from .workspace import *
+from .outer_solver import *
+comm = MPI.COMM_WORLD
+
+
+def coarsen_material(mat,factor):
+
+    #Merges azimuthal sectors of about factor directions within each polar ring, keeping the MFP
+    #sampling. All the angular sets have the azimuthal angle as the fastest index, with
+    #sampling[0] directions per ring. Merged directions are rescaled in the plane so that the
+    #mean of a sector has the in-plane norm of its directions.
+    n_dir = mat['VMFP'].shape[0]
+    n_phi = int(mat['sampling'][0]) if 'sampling' in mat.keys() else n_dir
+    if n_phi < 1 or n_dir % n_phi > 0: n_phi = n_dir
+    n_sector = max([n_phi//factor,1])
+    ring,phi = np.divmod(np.arange(n_dir),n_phi)
+    labels = ring*n_sector + phi*n_sector//n_phi
+    n_c = (n_dir//n_phi)*n_sector
+    S = sp.csr_matrix((np.ones(n_dir),(labels,np.arange(n_dir))),shape=(n_c,n_dir))
+    counts = np.asarray(S.sum(axis=1)).ravel()
+
+    VMFP = S.dot(mat['VMFP'])/counts[:,np.newaxis]
+    norm = S.dot(np.linalg.norm(mat['VMFP'][:,:2],axis=1))/counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+      scale = norm/np.linalg.norm(VMFP[:,:2],axis=1); scale[~np.isfinite(scale)] = 1
+    VMFP[:,:2] *= scale[:,np.newaxis]
+
+    return {'tc':S.dot(mat['tc'].T).T,\
+            'sigma':np.einsum('cq,mqj->mcj',S.toarray(),mat['sigma']),\
+            'VMFP':VMFP,\
+            'mfp_sampled':mat['mfp_sampled']}
+
+
+class AngularTwoLevel(object):
+
+  #Two-level angular scheme: the change r of (DeltaT,TB) in a sweep over the fine angular set
+  #drives the error equation e = M_c e + r on a coarse set, obtained by merging
+  #angular_coarsening directions into one. A few GMRES iterations over coarse sweeps
+  #(angular_coarse_iter) give the correction M_c e that is added to (DeltaT,TB).
+  #A too coarse set can amplify some error modes: if r grows from one iteration to the next,
+  #the corrections are stopped.
+
+  def __init__(self,argv,Master,conversion):
+
+      self.factor = argv.setdefault('angular_coarsening',0)
+      self.iterations = argv.setdefault('angular_coarse_iter',10)
+      #coarse sets of less than four directions are not used
+      self.enabled = self.factor > 1 and not argv['multiscale']
+      if not self.enabled: return
+      coarse = coarsen_material(argv['mat'],self.factor)
+      self.enabled = coarse['VMFP'].shape[0] >= 4
+      if not self.enabled: return
+
+      mesh = argv['mesh']
+      self.mesh = mesh
+      self.n_elems = len(mesh['elems'])
+      self.n_serial = argv['n_serial']
+      self.thermalizing = argv.setdefault('thermalizing',True)
+      self.tc = coarse['tc']
+      self.n_c = coarse['VMFP'].shape[0]
+      block = self.n_c//comm.size
+      self.rr = range(block*comm.rank,self.n_c) if comm.rank == comm.size-1 else range(block*comm.rank,block*(comm.rank+1))
+
+      #Bulk and boundary operators of the coarse directions (no periodic term: the error
+      #equation is homogeneous)
+      G = np.einsum('qj,jn->qn',coarse['VMFP'][self.rr],mesh['k'],optimize=True)
+      Gp = G.clip(min=0); Gm = G.clip(max=0)
+      D = np.zeros((len(self.rr),self.n_elems))
+      np.add.at(D.T,mesh['i'],Gp.T)
+      if len(mesh['db']) > 0:
+        tmp = np.einsum('rj,jn->rn',coarse['VMFP'][self.rr],mesh['db'],optimize=True)
+        np.add.at(D.T,mesh['eb'],tmp.clip(min=0).T)
+        self.Gbm2 = tmp.clip(max=0)
+
+        Gb = np.einsum('mqj,jn->mqn',coarse['sigma'],mesh['db'],optimize=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+          if self.thermalizing:
+           tot = 1/Gb.clip(max=0).sum(axis=0).sum(axis=0); tot[np.isinf(tot)] = 0
+           self.GG = np.einsum('mqs,s->mqs',Gb.clip(min=0),tot)
+          else:
+           tot = 1/Gb.clip(max=0).sum(axis=1); tot[np.isinf(tot)] = 0
+           self.GG = np.einsum('mqs,ms->mqs',Gb.clip(min=0),tot)
+
+      self.inner = InnerSolver(Master.copy(),conversion,Gm,D,coarse['mfp_sampled']*1e9,\
+                   dict(argv,rr=self.rr,mat=coarse,inner_solver='lu',lu_store=None))
+      self.work = Workspace(self.n_elems,mesh['eb'],argv['dim'])
+      self.zeros = np.zeros(self.n_elems)
+      self.stats = {'fine':0,'coarse':0}
+      self.norm = None
+      self.stopped = False
+
+  def sweep(self,x,affine):
+
+      #coarse sweep of the error equation; with affine, the source r is added
+      n_elems = self.n_elems; eb = self.mesh['eb']
+      eT = x[:n_elems]; eB = x[n_elems:].reshape(self.shape)
+      Tp = np.zeros(n_elems); Bp = np.zeros_like(eB)
+      if len(eb) > 0:
+        RHS = -np.einsum('c,nc->nc',eB,self.Gbm2) if eB.ndim == 1 else -np.einsum('mc,nc->mnc',eB,self.Gbm2)
+      for n,q in enumerate(self.rr):
+         for m in range(self.n_serial):
+            if self.tc[m,q] == 0: continue
+            R = self.zeros
+            if len(eb) > 0: R = self.work.get_boundary(R,RHS[n] if eB.ndim == 1 else RHS[m,n])
+            X = self.inner.solve(m,n,eT,R)
+            self.stats['coarse'] +=1
+            np.multiply(X,self.tc[m,q],out=self.work.T)
+            Tp += self.work.T
+            if len(eb) > 0:
+              if eB.ndim == 1: Bp -= X[eb]*self.GG[m,q]
+              else: Bp[m] -= X[eb]*self.GG[m,q]
+
+      output = {'x':np.zeros_like(x)}
+      comm.Allreduce([Tp,MPI.DOUBLE],[output['x'][:n_elems],MPI.DOUBLE],op=MPI.SUM)
+      comm.Allreduce([Bp.ravel(),MPI.DOUBLE],[output['x'][n_elems:],MPI.DOUBLE],op=MPI.SUM)
+      if affine: output['x'] += self.r
+
+      return output
+
+  def correct(self,rT,rB,n_fine):
+
+      #n_fine: fine solves of this rank in the sweep that produced r
+      self.stats['fine'] += n_fine
+      self.shape = rB.shape
+      self.r = np.concatenate((rT,rB.ravel()))
+
+      #safeguard
+      norm = np.linalg.norm(self.r)
+      self.stopped = self.stopped or (self.norm is not None and norm > self.norm)
+      self.norm = norm
+      if self.stopped: return np.zeros_like(rT),np.zeros_like(rB)
+
+      count = [0]
+      def callback(output):
+          count[0] +=1
+          return count[0] > self.iterations
+      x,output = outer_gmres(self.sweep,np.zeros_like(self.r),{'outer_restart':self.iterations},callback)
+      e = output['x'] - self.r
+
+      return e[:self.n_elems],e[self.n_elems:].reshape(self.shape)
+
+  def reset_stats(self):
+
+      #fine and coarse solves of the last iteration, and whether corrections were stopped
+      stats = np.array([self.stats['fine'],self.stats['coarse'],self.stopped],dtype=np.float64)
+      for key in self.stats.keys(): self.stats[key] = 0
+      return stats
+
+
+def print_angular(stats):
+
+        total = max([stats[0] + stats[1],1])
+        print(flush=True)
+        print('                  Angular Two-Level Diagnostics        ',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
+        print(colored(' FINE SOLVES:      ','green') + str(int(stats[0])) + ' (' + str(round(stats[0]/total*100,2)) + ' %)',flush=True)
+        print(colored(' COARSE SOLVES:    ','green') + str(int(stats[1])) + ' (' + str(round(stats[1]/total*100,2)) + ' %)',flush=True)
+        if stats[2] > 0: print(colored(' STOPPED:          ','green') + 'residual growth',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
+from .fourier import *
+
+
+class DSA(object):
+
+  #Diffusion synthetic acceleration of the outer BTE loop. With r = DeltaT_new - DeltaT_old
+  #the change of one sweep, the error left after the sweep is approximately the solution of
+  #-div(K grad e) = r, with K averaged over the bins; e is added back to the
+  #temperature (and to the boundary temperature). The diffusion operator is the one of the
+  #Fourier solver (cache['F']), factorized once.
+
+  def __init__(self,argv):
+
+      self.enabled = argv.setdefault('dsa',False)
+      if not self.enabled: return
+
+      mat  = argv['mat']
+      mesh = argv['mesh']
+      assemble_fourier(argv)
+
+      #mfp^2 s_j^2 + mfp |s_j| h/2 for each axis: the second term is the numerical diffusion
+      #of the upwind scheme, h being the typical element size. It dominates for elements larger
+      #than the MFP, where it keeps the correction consistent with the discrete transport.
+      dim = argv['dim']
+      mfp = mat['mfp_sampled']*1e9
+      h   = np.mean(mesh['volumes']**(1.0/dim))
+      s   = np.absolute(mat['VMFP'][:,:dim])
+      K   = (np.einsum('mq,m,qj->',mat['tc'],mfp**2,s**2) + np.einsum('mq,m,qj->',mat['tc'],mfp*h/2,s))/np.sum(mat['tc'])/dim
+
+      #the constant (mean temperature) is not changed by the sweeps: it is removed from r
+      #and e, and a small shift makes the singular diffusion operator invertible
+      F = K*argv['cache']['F']
+      shift = 1e-10*abs(F.diagonal()).mean()
+      self.lu = splu(sp.csc_matrix(F + shift*sp.eye(F.shape[0])))
+      self.volumes = mesh['volumes']/np.sum(mesh['volumes'])
+
+  def correct(self,DeltaT,DeltaT_old):
+
+      r = DeltaT - DeltaT_old
+      r -= np.dot(self.volumes,r)
+      e = self.lu.solve(r)
+      e -= np.dot(self.volumes,e)
+
+      return e
@@ -8,11 +8,9 @@ import scipy.sparse as sp
 import time
 import scikits.umfpack as um
 from scipy.sparse.linalg import lgmres
-import scikits.umfpack as um
 import sys
 from shapely.geometry import LineString
 import scipy
-from .solve_mfp import *
 
 comm = MPI.COMM_WORLD
 
@@ -20,95 +18,16 @@ comm = MPI.COMM_WORLD
 
 def compute_grad(temp,argv):
 
-    #if not 'rr' in argv['cache']:
-
-    rr = [i*[0]   for k,i in enumerate(argv['mesh']['n_side_per_elem']) ]
-
-    for ll in argv['mesh']['active_sides'] :   
-      kc1,kc2 = argv['mesh']['side_elem_map_vec'][ll]
-      #if not kc1 == kc2 :
-      #if 1 == 1:    
-      ind1 = list(argv['mesh']['elem_side_map_vec'][kc1]).index(ll)
-      ind2 = list(argv['mesh']['elem_side_map_vec'][kc2]).index(ll)
-      temp_1 = temp[kc1]
-      temp_2 = temp[kc2]
-
-      if ll in argv['mesh']['periodic_sides']:
-        delta= argv['mesh']['periodic_side_values'][list(argv['mesh']['periodic_sides']).index(ll)]
-      else: 
-       delta = 0   
- 
-      #if ll in argv['mesh']['boundary_sides']:
-      #   delta = 1
-
-      rr[kc1][ind1] = [kc2,kc1,delta] 
-      rr[kc2][ind2] = [kc1,kc2,-delta]
-
-    #argv['cache']['rr'] = rr
-
-    #for r in rr: print(r)
-    #diff_temp = [[temp[j[0]]-temp[j[1]]+j[2] for j in f] for f in rr]
-    #gradT = np.array([np.einsum('js,s->j',argv['mesh']['weigths'][k,:,:argv['mesh']['n_non_boundary_side_per_elem'][k]],np.array(dt)) for k,dt in enumerate(diff_temp)])
-    diff_temp = [[temp[j[0]]-temp[j[1]]+j[2] for j in f] for f in rr]
-    gradT = np.array([np.einsum('js,s->j',argv['mesh']['weigths'][k,:,:argv['mesh']['n_non_boundary_side_per_elem'][k]],np.array(dt)) for k,dt in enumerate(diff_temp)])
-
-    return gradT
+    return compute_gradient(temp,argv['mesh'])
 
 
 def compute_secondary_flux(argv,temp,kappa):
 
-   if not 'rr' in argv['cache']:
-
-    rr = [i*[0]   for k,i in enumerate(argv['mesh']['n_side_per_elem']) ]
-
-    for ll in argv['mesh']['active_sides'] :
-     kc1,kc2 = argv['mesh']['side_elem_map_vec'][ll]
-     ind1 = list(argv['mesh']['elem_side_map_vec'][kc1]).index(ll)
-     ind2 = list(argv['mesh']['elem_side_map_vec'][kc2]).index(ll)
-     temp_1 = temp[kc1]
-     temp_2 = temp[kc2]
-
-     if ll in argv['mesh']['periodic_sides']:
-        delta= argv['mesh']['periodic_side_values'][list(argv['mesh']['periodic_sides']).index(ll)]
-     else: 
-        delta = 0   
+   #non-orthogonal correction, through the sparse operators of the geometry
+   gradT = compute_gradient(temp,argv['mesh'])
+   C = kappa*get_mesh_operators(argv['mesh'])['flux'].dot(gradT.ravel())
 
- 
-     rr[kc1][ind1] = [kc2,kc1,delta] 
-     rr[kc2][ind2] = [kc1,kc2,-delta] 
-
-    argv['cache']['rr'] = rr
-
-
-   diff_temp = [[temp[j[0]]-temp[j[1]]+j[2] for j in f] for f in argv['cache']['rr']]
-   gradT = np.array([np.einsum('js,s->j',argv['mesh']['weigths'][k,:,:argv['mesh']['n_non_boundary_side_per_elem'][k]],np.array(dt)) for k,dt in enumerate(diff_temp)])
-   #-----------------------------------------------------
-
-   #-----------SAVE some time--------------------------------------
-   if not 'v_non_orth' in argv['cache'].keys():
-    v_non_orth = {}
-    for ll in argv['mesh']['active_sides']:
-      (i,j) = argv['mesh']['side_elem_map_vec'][ll]
-      if not i==j:
-       area = argv['mesh']['areas'][ll]   
-       normal = argv['mesh']['face_normals'][ll,0:argv['dim']]
-       dist   = argv['mesh']['dists'][ll,0:argv['dim']]
-       v_orth = 1/np.dot(normal,dist)
-       v_non_orth[ll] = ((normal - dist*v_orth)*area)[:argv['dim']]
-    argv['cache']['v_non_orth'] = v_non_orth
-   #-----------------------------------------------------------------
-
-   C = np.zeros(argv['n_elems'])
-   for ll in argv['mesh']['active_sides']:
-      (i,j) = argv['mesh']['side_elem_map_vec'][ll]
-      if not i==j:
-       w = argv['mesh']['interp_weigths'][ll]
-       F_ave = (w*gradT[i] + (1.0-w)*gradT[j])*kappa
-       tmp = np.dot(F_ave,argv['cache']['v_non_orth'][ll])
-       C[i] += tmp
-       C[j] -= tmp
-
-   return C/argv['mesh']['volumes'],gradT
+   return C,gradT
 
 
 
@@ -132,14 +51,16 @@ def compute_diffusive_thermal_conductivity(argv,temp,kappa):
 
 
 
-def fourier_scalar(m,kappa,DeltaT,C,argv):
+def fourier_scalar(m,kappa,DeltaT,C,argv,kappa_old=0):
 
+    #C: secondary flux of the first pass; kappa_old: expected kappa (with a good guess for
+    #both, e.g. the solution of the previous BTE iteration, one pass is enough: the first
+    #pass is accepted only if it also leaves the secondary flux unchanged)
     C *=kappa 
     n_elems = len(argv['mesh']['elems'])
     dim = int(argv['mesh']['meta'][2])
 
     n_iter = 0
-    kappa_old = 0
     error = 1  
 
     #tmp = np.zeros(n_elems)
@@ -169,9 +90,13 @@ def fourier_scalar(m,kappa,DeltaT,C,argv):
         error = abs((kappa_eff - kappa_old)/kappa_eff)
         kappa_old = kappa_eff
         n_iter +=1
+        C_old = C
         C,grad = compute_secondary_flux(argv,temp,kappa)
+        if n_iter == 1:
+          norm = np.linalg.norm(C)
+          error = max([error,np.linalg.norm(C-C_old)/norm if norm > 0 else 0])
 
-    flux = -grad*kappa
+    argv['cache'].setdefault('fourier_stats',{'passes':0,'reused':0})['passes'] += n_iter
     return kappa_eff,temp,grad,C/kappa
 
 
@@ -245,19 +170,64 @@ def solve_fourier(kappa,DeltaT,argv):
     tf = shared_array(np.zeros((argv['n_serial'],argv['n_elems'])) if comm.rank == 0 else None)
     tfg = shared_array(np.zeros((argv['n_serial'],argv['n_elems'],argv['dim'])) if comm.rank == 0 else None)
 
-    if comm.rank == 0:
+    assemble_fourier(argv)
+    cache = argv['cache']
+    stats = cache.setdefault('fourier_stats',{'passes':0,'reused':0})
+
+    #With fourier_reuse_tol, the solutions of the last solve are reused while DeltaT has changed
+    #by less than fourier_reuse_tol (relative, max norm) since then: each Fourier solution
+    #changes by at most as much as DeltaT.
+    tol = argv.setdefault('fourier_reuse_tol',None)
+    if tol is not None and 'DeltaT' in cache.setdefault('fourier',{}).keys() and \
+       np.max(np.absolute(DeltaT - cache['fourier']['DeltaT'])) <= tol*np.ptp(cache['fourier']['DeltaT']):
+       if comm.rank == 0:
+         tf[:] = cache['fourier']['tf']; tfg[:] = cache['fourier']['tfg']
+       stats['reused'] += 1
+       comm.Barrier()
+       return tf,tfg
+
+    #With fourier_warm_start, the secondary flux and kappa of each MFP are kept for the next
+    #BTE iteration and are the starting point of the non-orthogonal corrections
+    warm = argv.setdefault('fourier_warm_start',False)
+    guess = cache.setdefault('fourier_guess',{})
+
+    #The MFPs are solved in rounds of comm.size, MFP m by rank m % comm.size, which writes into
+    #the shared tf and tfg and keeps the factorizations of its MFPs. The kappas of each round
+    #are summed over the ranks, so that all of them take the same early-termination decision.
+    passes = stats['passes']
+    n_mfp = len(kappa)
+    kappas = np.zeros(n_mfp)
+    stop = n_mfp
+    C = np.zeros(argv['n_elems'])
+    for start in range(0,n_mfp,comm.size):
+        kappap = np.zeros(n_mfp)
+        m = start + comm.rank
+        if m < n_mfp:
+          kappa_guess = 0
+          if warm and m in guess.keys(): C,kappa_guess = guess[m][0].copy(),guess[m][1]
+          kappap[m],tf[m,:],tfg[m,:,:],C = fourier_scalar(m,kappa[m],DeltaT,C,argv,kappa_guess)
+          if warm: guess[m] = (C.copy(),kappap[m])
+        tmp = np.zeros(n_mfp)
+        comm.Allreduce([kappap,MPI.DOUBLE],[tmp,MPI.DOUBLE],op=MPI.SUM)
+        kappas += tmp
+
+        for m in range(start,min([start+comm.size,n_mfp])):
+          if m > int(n_mfp/4) and abs((kappas[m]-kappas[m-1]))/kappas[m] < 1e-2:
+            stop = m
+            break
+        if stop < n_mfp: break
+
+    P = np.zeros(1)
+    comm.Allreduce([np.array([stats['passes'] - passes],dtype=np.float64),MPI.DOUBLE],[P,MPI.DOUBLE],op=MPI.SUM)
+    stats['passes'] = passes + int(P[0])
 
-     assemble_fourier(argv)
-
-     old_kappa = 0
-     C = np.zeros(argv['n_elems'])
-     for m,k in enumerate(kappa):
-         kappaf,tf[m,:],tfg[m,:,:],C = fourier_scalar(m,k,DeltaT,C,argv)
-         if m > int(len(kappa)/4) and abs((kappaf-old_kappa))/kappaf < 1e-2:
-          tf[m:,:]  = tf[m-1]; tfg[m:,:,:] = tfg[m-1] 
-          break 
-         else:  
-          old_kappa = kappaf
+    comm.Barrier()
+    if comm.rank == 0:
+      if stop < n_mfp:
+        tf[stop:,:]  = tf[stop-1]; tfg[stop:,:,:] = tfg[stop-1]
+      if tol is not None:
+        cache['fourier'].update({'tf':np.array(tf),'tfg':np.array(tfg)})
+    if tol is not None: cache['fourier']['DeltaT'] = DeltaT.copy()
 
     comm.Barrier()
     return tf,tfg
@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+import numpy as np
+from termcolor import colored, cprint
+
+
+class BinFreezer(object):
+
+  #(MFP,direction) bins whose solution stopped changing are frozen: their last contributions
+  #are kept in accumulators and they are not solved again until the next refresh.
+  #Only bins solved by the BTE are tracked, so it is not used with multiscale.
+
+  def __init__(self,shape,argv):
+
+      self.tol     = argv.setdefault('freeze_tol',None)
+      self.refresh = argv.setdefault('freeze_refresh',5)
+      self.enabled = self.tol is not None and not argv['multiscale']
+      self.frozen  = np.zeros(shape,dtype=bool)
+      self.previous = {} #last solution of each bin (single precision)
+      self.diff = None
+      self.accumulators = {}
+      self.force_refresh = False
+
+  def start(self,kk,data):
+
+      #accumulators of a new BTE iteration, starting from the frozen contributions
+      if kk % self.refresh == 0 or self.force_refresh or not self.accumulators:
+         self.frozen[:] = False
+         self.accumulators = {key:np.zeros_like(value) for key,value in data.items()}
+         self.force_refresh = False
+      self.n_frozen = self.frozen.sum()
+
+      return {key:value.copy() for key,value in self.accumulators.items()}
+
+  def converged(self,m,q,X,kappa_old,kappa_new):
+
+      #relative change of the bin's kappa and of its contribution to the temperature
+      if not self.enabled: return False
+
+      previous = self.previous.get((m,q))
+      if previous is None:
+         self.previous[(m,q)] = X.astype(np.float32)
+         return False
+
+      if self.diff is None: self.diff = np.zeros_like(X)
+      np.subtract(X,previous,out=self.diff)
+      np.copyto(previous,X,casting='same_kind')
+
+      return abs(kappa_new - kappa_old) <= self.tol*abs(kappa_new) and \
+             np.linalg.norm(self.diff) <= self.tol*np.linalg.norm(X)
+
+  def freeze(self,m,q,contributions):
+
+      self.frozen[m,q] = True
+      for key,value in contributions.items():
+         self.accumulators[key] += value
+
+
+def print_freezing(FF):
+
+        print(flush=True)
+        print('                  Frozen Bins Diagnostics        ',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
+        print(colored(' FROZEN:           ','green') + str(int(FF[0])) + '/' + str(int(FF[1])) + ' (' + str(round(FF[0]/max([FF[1],1])*100,2)) + ' %)',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
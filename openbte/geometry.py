@@ -21,6 +21,10 @@ class Geometry(object):
  def __init__(self,**argv):
 
   if comm.rank == 0:
+   if argv.setdefault('coarse_step',None) is not None and not argv.setdefault('user',False):
+    #the same geometry with a larger step, e.g. for the warm start of Solver (coarse_geometry)
+    self.coarse = Geometry(**dict(argv,step=argv['coarse_step'],coarse_step=None,save=False)).state
+    if argv.setdefault('save',True): save_data('geometry_coarse',self.coarse)
    if argv.setdefault('only_geo',False):
      Mesher(argv) #this create mesh.msh
    else:    
@@ -71,6 +75,7 @@ class Geometry(object):
     self.compute_connecting_matrix()
     self.compute_interpolation_weigths()
     self.compute_dists()
+    if argv.setdefault('tensor',False): self.compute_tensor_data(argv)
     self.compute_boundary_condition_data(argv)
     #self.compute_node_map()
 
@@ -117,7 +122,7 @@ class Geometry(object):
        
 
 
-    return {
+    data = {
           'size':self.size,\
           #'conn':self.conn,\
           'elems':np.array(self.elems),\
@@ -150,7 +155,7 @@ class Geometry(object):
           'jm': np.concatenate((self.j,list(np.arange(self.n_elems)))),\
           'k':self.k,\
           'eb':np.array(self.eb),\
-          'sb':np.array(self.sb),\
+          'sb':np.array(self.sb,dtype=np.int),\
           'db':self.db,\
           'active_sides':np.array(self.side_list['active']),
           'inactive_sides':np.array(self.side_list['Inactive']),
@@ -164,6 +169,38 @@ class Geometry(object):
           'applied_gradient':np.array(self.applied_grad),\
           'meta':np.asarray([self.n_elems,self.kappa_factor,self.dim,len(self.nodes),len(self.side_list['active']),dirr],np.float64)}
 
+    if argv['tensor']: data.update(self.tensor)
+
+    #sparse gradient and non-orthogonal flux operators (triplets)
+    data.update(compute_mesh_operators(data))
+
+    return data
+
+ def compute_tensor_data(self,argv):
+
+    #Boundary-condition data for a unit gradient along each axis. Variable-length arrays are
+    #concatenated with offsets, so that they can be shared across ranks.
+    #Only the axes with periodic sides normal to them (flux sides) can carry a gradient.
+    pp = []; kappa_mask = []; periodic_side_values = []; flux_sides = []; kappa_factor = []
+    normals = np.array([self.face_normals[ll] for ll in self.side_list.setdefault('Periodic',[])]).reshape((-1,3))
+    directions = [d for d in range(self.dim) if np.any(np.abs(normals[:,d]) == 1)]
+    for d in directions:
+      self.compute_boundary_condition_data({'direction':['x','y','z'][d]})
+      pp.append(np.array(self.pp,dtype=np.float64).reshape((-1,2)))
+      kappa_mask.append(-np.array(np.sum(self.B_with_area_old.todense(),axis=0))[0]*self.kappa_factor*1e-18)
+      periodic_side_values.append([self.periodic_side_values[ll] for ll in self.side_list['Periodic']])
+      flux_sides.append(self.flux_sides)
+      kappa_factor.append(self.kappa_factor)
+
+    self.tensor = {'pp_tensor':np.concatenate(pp),\
+                   'pp_tensor_offset':np.cumsum([0] + [len(p) for p in pp]),\
+                   'kappa_mask_tensor':np.array(kappa_mask),\
+                   'periodic_side_values_tensor':np.array(periodic_side_values,dtype=np.float64),\
+                   'flux_sides_tensor':np.array(np.concatenate(flux_sides),dtype=int),\
+                   'flux_sides_tensor_offset':np.cumsum([0] + [len(f) for f in flux_sides]),\
+                   'kappa_factor_tensor':np.array(kappa_factor),\
+                   'tensor_directions':np.array(directions,dtype=np.int64)}
+
 
 
  def compute_dists(self):
@@ -654,6 +691,9 @@ class Geometry(object):
            else:
             area_flux = self.size[0]*self.size[2]
 
+       elif abs(normal[2]) == 1:
+            area_flux = self.size[0]*self.size[1]
+
        self.flux_sides.append(ll)
 
     
@@ -0,0 +1,501 @@
+from __future__ import absolute_import
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu,spilu,gmres,bicgstab,gcrotmk,LinearOperator
+from scipy.sparse.csgraph import connected_components
+import time
+from termcolor import colored, cprint
+from .lu_cache import *
+
+
+#Per-(MFP,direction) linear solves of the BTE.
+#Each system reads  (I + mfp[m]*(Gm[n] + D[n])) X = T + mfp[m]*R
+#where T is the current temperature and R collects the periodic and boundary terms.
+
+
+def get_opposite_directions(VMFP):
+
+    #index of the direction opposite to each one of VMFP (-1 if there is none)
+    VMFP = np.array(VMFP)
+    norm = np.linalg.norm(VMFP,axis=1)
+    dist = np.linalg.norm(VMFP[:,np.newaxis,:] + VMFP[np.newaxis,:,:],axis=2)
+    opposite = np.argmin(dist,axis=1)
+    opposite[dist[np.arange(len(VMFP)),opposite] > 1e-8*norm] = -1
+
+    return opposite
+
+
+def get_paired_partition(VMFP,size,rank):
+
+    #partition of the directions that keeps opposite ones on the same rank
+    opposite = get_opposite_directions(VMFP)
+    units = [[q,int(q2)] for q,q2 in enumerate(opposite) if q2 > q]
+    units += [[q] for q,q2 in enumerate(opposite) if q2 == -1 or q2 == q]
+
+    n = len(units)
+    return sorted(sum(units[n*rank//size:n*(rank+1)//size],[]))
+
+
+def get_periodic_pairs(mesh):
+
+    #mask of the (i,j) element pairs coupled through a periodic side
+    n_elems = len(mesh['elems'])
+    sides = np.array(mesh['periodic_sides'],dtype=int)
+    if len(sides) == 0: return np.zeros(len(mesh['i']),dtype=bool)
+    e = np.array(mesh['side_elem_map_vec'],dtype=np.int64)[sides]
+    keys = np.concatenate((e[:,0]*n_elems + e[:,1],e[:,1]*n_elems + e[:,0]))
+
+    return np.isin(np.array(mesh['i'],dtype=np.int64)*n_elems + np.array(mesh['j'],dtype=np.int64),keys)
+
+
+def call_krylov(method,A,b,tol,**argv):
+
+    #scipy renamed tol into rtol
+    try:
+      return method(A,b,rtol=tol,atol=0.0,**argv)
+    except TypeError:
+      return method(A,b,tol=tol,atol=0.0,**argv)
+
+
+class InnerSolver(object):
+
+  def __init__(self,Master,conversion,Gm,D,mfp,argv):
+
+      self.Master     = Master
+      self.conversion = conversion
+      self.Gm         = Gm
+      self.D          = D
+      self.mfp        = mfp
+      self.n_elems    = Master.shape[0]
+      #buffers written in place by get_A and solve
+      self.data_buffer = np.zeros(Gm.shape[1]+self.n_elems)
+      self.B          = np.zeros(self.n_elems)
+      self.BV         = np.zeros(self.n_elems)
+      self.mode       = argv.setdefault('inner_solver','lu')
+      self.keep_lu    = argv.setdefault('keep_lu',True)
+      memory          = argv.setdefault('lu_memory',None) #MB
+      self.lu         = LUCache(None if memory is None else memory*1e6,argv.setdefault('lu_eviction','lru'))
+
+      #UMFPACK factors sharing one symbolic analysis
+      self.factory = None
+      if argv.setdefault('lu_backend','superlu') == 'umfpack':
+         self.factory = UmfpackFactory(Master)
+
+      #Single-precision factors, refined against the double-precision matrix
+      self.precision  = argv.setdefault('lu_precision','double')
+      self.B32        = np.zeros(self.n_elems,dtype=np.float32)
+      self.refinement_tol = argv.setdefault('refinement_tol',1e-10)
+      self.refinement_maxiter = argv.setdefault('refinement_maxiter',10)
+
+      #Factors persisted across runs
+      self.store = None
+      if argv.setdefault('lu_store',None) is not None:
+         self.store = FactorStore(argv['lu_store'],argv['mesh'])
+         self.VMFP  = argv['mat']['VMFP'][argv['rr']]
+
+      #Opposite directions sharing the same factorization
+      self.partner = {}
+      if argv.setdefault('transpose_lu',True) and 'mat' in argv.keys():
+         self.volumes = argv['mesh']['volumes']
+         self.find_transpose_pairs(argv['mat']['VMFP'][argv['rr']])
+
+      #Transport sweeps
+      if self.mode == 'sweep':
+         self.sweep = {}
+         self.pair_i = np.array(argv['mesh']['i'],dtype=np.int64)
+         self.pair_j = np.array(argv['mesh']['j'],dtype=np.int64)
+         self.periodic_pairs = get_periodic_pairs(argv['mesh'])
+         self.sweep_tol = argv.setdefault('sweep_tol',1e-10)
+
+      #Preconditioned Krylov
+      if self.mode in ['gmres','bicgstab','gcrotmk']:
+         self.ilu_drop_tol = argv.setdefault('ilu_drop_tol',1e-4)
+         self.ilu_fill_factor = argv.setdefault('ilu_fill_factor',10)
+         self.ilu_band = argv.setdefault('ilu_band',4)
+         self.krylov_tol = argv.setdefault('krylov_tol',1e-10)
+         self.krylov_maxiter = argv.setdefault('krylov_maxiter',200)
+         self.recycle_dim = argv.setdefault('recycle_dim',10)
+         self.gcrot_dim = argv.setdefault('gcrot_dim',20)
+
+      #Shifted Krylov
+      self.krylov_dim = argv.setdefault('shifted_krylov_dim',60)
+      self.shifted_tol = argv.setdefault('shifted_tol',1e-8)
+      self.arnoldi = {}
+      self.arnoldi_n = -1
+      self.stats = {'shifted':0,'fallback':0,'sweeps':0,'krylov_solves':0,'krylov_iterations':0,'lu_solves':0,'refinements':0}
+
+
+  def get_key(self,m,n):
+
+      #the ballistic solve (m=-1) is the last MFP
+      return (m % len(self.mfp),n)
+
+  def get_A(self,m,n):
+
+      n_g = self.Gm.shape[1]
+      np.multiply(self.Gm[n],self.mfp[m],out=self.data_buffer[:n_g])
+      np.multiply(self.D[n],self.mfp[m],out=self.data_buffer[n_g:])
+      self.data_buffer[n_g:] += 1
+      np.take(self.data_buffer,self.conversion,out=self.Master.data)
+      return self.Master
+
+  def solve(self,m,n,T,R):
+
+      #several right-hand sides (columns): factorizations solve them at once
+      if T.ndim == 2 and not self.mode == 'lu':
+         return np.array([self.solve(m,n,T[:,d],R[:,d]) for d in range(T.shape[1])]).T
+
+      if self.mode == 'shifted':
+         X = self.solve_shifted(m,n,T,R)
+         if X is not None: return X
+
+      if T.ndim == 1:
+         B = np.multiply(R,self.mfp[m],out=self.B)
+         B += T
+      else: B = T + self.mfp[m]*R
+
+      if self.mode == 'sweep':
+         X = self.solve_sweep(m,n,B)
+         if X is not None: return X
+
+      if self.mode in ['gmres','bicgstab','gcrotmk']:
+         X = self.solve_krylov(m,n,B)
+         if X is not None: return X
+
+      return self.solve_lu(m,n,B)
+
+  def solve_lu(self,m,n,B):
+
+      if not self.keep_lu:
+         return sp.linalg.spsolve(self.get_A(m,n),B,use_umfpack=True)
+
+      self.stats['lu_solves'] +=1
+      X = self.apply_lu(m,n,B)
+      if self.precision == 'single':
+         X = self.refine(m,n,B,X)
+
+      return X
+
+  def apply_lu(self,m,n,B):
+
+      if n in self.partner.keys():
+         #A(-s) = V^-1 A(s)^T V
+         if B.ndim == 2:
+            V = self.volumes[:,np.newaxis]
+            return self.lu_solve(self.get_lu(m,self.partner[n]),B*V,trans='T')/V
+         np.multiply(B,self.volumes,out=self.BV)
+         X = self.lu_solve(self.get_lu(m,self.partner[n]),self.BV,trans='T')
+         X /= self.volumes
+         return X
+
+      return self.lu_solve(self.get_lu(m,n),B)
+
+  def lu_solve(self,lu,B,trans='N'):
+
+      #the solution is allocated by the factorization
+      if self.precision == 'single':
+         if B.ndim == 1:
+            np.copyto(self.B32,B,casting='same_kind')
+            return lu.solve(self.B32,trans=trans).astype(np.float64)
+         return lu.solve(B.astype(np.float32),trans=trans).astype(np.float64)
+
+      return lu.solve(B,trans=trans)
+
+  def refine(self,m,n,B,X):
+
+      #iterative refinement: residuals in double precision, corrections with the single-precision factors
+      A = self.get_A(m,n).copy()
+      norm = np.linalg.norm(B)
+      for k in range(self.refinement_maxiter):
+         r = B - A.dot(X)
+         if np.linalg.norm(r) <= self.refinement_tol*norm: break
+         X += self.apply_lu(m,n,r)
+         self.stats['refinements'] +=1
+
+      return X
+
+  def get_lu(self,m,n):
+
+      key = self.get_key(m,n)
+      lu = self.lu.get(key)
+      if lu is None:
+         a = time.time()
+         filename = None
+         if self.store is not None:
+            filename = self.store.get_hash(self.VMFP[n],self.mfp[key[0]]) + ('_single' if self.precision == 'single' else '')
+            lu = self.store.load(filename)
+         if lu is None:
+            if self.precision == 'single':
+               lu = splu(self.get_A(m,n).astype(np.float32))
+            elif self.factory is not None:
+               lu = self.factory.factorize(self.get_A(m,n))
+            else:
+               lu = splu(self.get_A(m,n))
+            if filename is not None and isinstance(lu,sp.linalg.SuperLU): self.store.save(filename,lu)
+         self.lu.put(key,lu,get_lu_nbytes(lu,4 if self.precision == 'single' else 8),time.time()-a)
+      return lu
+
+
+  def reset_stats(self):
+
+      #counters of the last BTE iteration: Krylov solves, Krylov iterations, direct fallbacks, LU solves, refinement steps
+      stats = np.array([self.stats[key] for key in ['krylov_solves','krylov_iterations','fallback','lu_solves','refinements']],dtype=np.float64)
+      for key in self.stats.keys(): self.stats[key] = 0
+      return stats
+
+
+  def get_permutation(self):
+
+      #fill-reducing ordering of the UMFPACK backend, e.g. to be stored with the geometry
+      return self.factory.get_permutation(self.get_A(0,0))
+
+
+  #Transpose pairs-----------------------------------------------------------
+  #With V the element volumes, V*(Gm+D) for -s is the transpose of V*(Gm+D) for s
+  #whenever the flux divergence of each element closes (no interface sides).
+
+  def find_transpose_pairs(self,VMFP):
+
+      opposite = get_opposite_directions(VMFP)
+      for n,n2 in enumerate(opposite):
+         if n2 > n:
+           VM  = sp.diags(self.volumes).dot(self.get_M(n))
+           VM2 = sp.diags(self.volumes).dot(self.get_M(n2))
+           diff = abs(VM2 - VM.T).max()
+           if diff <= 1e-10*abs(VM).max():
+              self.partner[int(n2)] = n
+
+
+  #Shifted Krylov------------------------------------------------------------
+  #For a fixed direction, (I + mfp*M)X = T + mfp*R is equivalent to
+  #(M + s*I)X = s*T + R with s = 1/mfp. Krylov spaces are shift-invariant, so a
+  #single Arnoldi process for T and one for R serve all MFPs of that direction.
+
+  def get_M(self,n):
+
+      M = self.Master.copy()
+      M.data = np.concatenate((self.Gm[n],self.D[n]))[self.conversion]
+      return M
+
+  def get_arnoldi(self,name,b):
+
+      #Rebuild only if the right-hand side changed
+      data = self.arnoldi.get(name)
+      if data is not None and np.array_equal(data['b'],b):
+         return data
+
+      beta = np.linalg.norm(b)
+      V = np.zeros((self.krylov_dim+1,self.n_elems))
+      H = np.zeros((self.krylov_dim+1,self.krylov_dim))
+      if beta > 0: V[0] = b/beta
+      data = {'b':b.copy(),'beta':beta,'V':V,'H':H,'k':0,'breakdown':beta == 0}
+      self.arnoldi[name] = data
+      return data
+
+  def extend_arnoldi(self,data,k_new):
+
+      V = data['V']; H = data['H']
+      for k in range(data['k'],k_new):
+         w = self.M.dot(V[k])
+         for i in range(k+1): #modified Gram-Schmidt
+            H[i,k] = np.dot(V[i],w)
+            w -= H[i,k]*V[i]
+         H[k+1,k] = np.linalg.norm(w)
+         data['k'] = k+1
+         if H[k+1,k] <= 1e-14*abs(H[k,k]):
+            data['breakdown'] = True
+            break
+         V[k+1] = w/H[k+1,k]
+
+  def shifted_fom(self,data,s):
+
+      #FOM solution of (H + s*I)y = beta*e_1 and its residual norm
+      k = data['k']
+      if data['beta'] == 0: return np.zeros(k),0.0
+      if k == 0: return np.zeros(k),data['beta']
+      rhs = np.zeros(k); rhs[0] = data['beta']
+      y = np.linalg.solve(data['H'][:k,:k] + s*np.eye(k),rhs)
+      res = 0.0 if data['breakdown'] else abs(data['H'][k,k-1]*y[-1])
+      return y,res
+
+  def solve_shifted(self,m,n,T,R):
+
+      #Krylov bases are kept for one direction at a time
+      if not n == self.arnoldi_n:
+         self.M = self.get_M(n)
+         self.arnoldi = {}
+         self.arnoldi_n = n
+
+      s = 1/self.mfp[m]
+      dT = self.get_arnoldi('T',T)
+      dR = self.get_arnoldi('R',R)
+      norm = np.linalg.norm(T + self.mfp[m]*R)
+      k = max([dT['k'],dR['k'],10])
+      while True:
+         for d in (dT,dR):
+           if not d['breakdown'] and d['k'] < k: self.extend_arnoldi(d,k)
+         yT,rT = self.shifted_fom(dT,s)
+         yR,rR = self.shifted_fom(dR,s)
+         #rT + mfp*rR bounds the residual of the original system
+         if rT + self.mfp[m]*rR <= self.shifted_tol*norm:
+            self.stats['shifted'] +=1
+            return s*np.dot(yT,dT['V'][:dT['k']]) + np.dot(yR,dR['V'][:dR['k']])
+         if k >= self.krylov_dim or (dT['breakdown'] and dR['breakdown']):
+            break
+         k = min([2*k,self.krylov_dim])
+
+      #not converged (typically the most ballistic MFPs): direct solve
+      self.stats['fallback'] +=1
+      return None
+
+
+  #Transport sweeps----------------------------------------------------------
+  #Row i depends on element j when Gm[n] < 0 for the pair (i,j). Without the periodic
+  #couplings this graph is acyclic and the system is solved level by level in O(nnz).
+  #Periodic couplings (and any residual cycle) are lagged and closed with GMRES,
+  #preconditioned by the sweep.
+
+  def get_sweep(self,n):
+
+      if n in self.sweep.keys(): return self.sweep[n]
+
+      i = self.pair_i; j = self.pair_j; N = self.n_elems
+      upwind = self.Gm[n] < 0
+      lag = upwind & self.periodic_pairs
+      low = upwind & ~self.periodic_pairs
+
+      #residual cycles (e.g. non-convex elements)
+      G = sp.csr_matrix((np.ones(np.count_nonzero(low)),(i[low],j[low])),shape=(N,N))
+      n_comp,labels = connected_components(G,directed=True,connection='strong')
+      if n_comp < N:
+         cycle = low & (labels[i] == labels[j])
+         lag |= cycle; low &= ~cycle
+
+      Lower = sp.csr_matrix((self.Gm[n][low],(i[low],j[low])),shape=(N,N))
+      Lag   = sp.csr_matrix((self.Gm[n][lag],(i[lag],j[lag])),shape=(N,N))
+
+      #topological levels (Kahn)
+      indeg = np.diff(Lower.indptr)
+      dependents = Lower.T.tocsr()
+      levels = []
+      frontier = np.where(indeg == 0)[0]
+      while len(frontier) > 0:
+         levels.append((frontier,Lower[frontier]))
+         indeg[frontier] = -1
+         indeg -= np.bincount(dependents[frontier].indices,minlength=N)
+         frontier = np.where(indeg == 0)[0]
+
+      self.sweep[n] = {'levels':levels,'Lower':Lower,'Lag':Lag}
+      return self.sweep[n]
+
+  def sweep_solve(self,data,m,n,b):
+
+      x = np.zeros(self.n_elems)
+      d = 1 + self.mfp[m]*self.D[n]
+      for rows,L in data['levels']:
+         x[rows] = (b[rows] - self.mfp[m]*L.dot(x))/d[rows]
+      self.stats['sweeps'] +=1
+      return x
+
+  def solve_sweep(self,m,n,B):
+
+      data = self.get_sweep(n)
+      X = self.sweep_solve(data,m,n,B)
+      if data['Lag'].nnz == 0: return X
+
+      mfp = self.mfp[m]; D = self.D[n]
+      A = LinearOperator((self.n_elems,self.n_elems),dtype=np.float64,\
+          matvec = lambda x: x + mfp*(D*x + data['Lower'].dot(x) + data['Lag'].dot(x)))
+      M = LinearOperator((self.n_elems,self.n_elems),dtype=np.float64,\
+          matvec = lambda x: self.sweep_solve(data,m,n,x))
+      X,info = call_krylov(gmres,A,B,self.sweep_tol,x0=X,M=M,restart=50,maxiter=20)
+      if info == 0: return X
+
+      #not converged (strongly ballistic, fully periodic): direct solve
+      self.stats['fallback'] +=1
+      return None
+
+
+  #Preconditioned Krylov-----------------------------------------------------
+  #Consecutive MFPs are grouped into bands of ilu_band; all the systems of a band share
+  #the incomplete factorization of the one at the center of the band. The solution of the
+  #previous BTE iteration is the initial guess.
+  #Matrices do not change across BTE iterations: with gcrotmk the subspace pairs (C = A U)
+  #deflated by each solve is recycled by the next solve of the same system (GCRO-DR).
+
+  def get_ilu(self,m,n):
+
+      band = (m % len(self.mfp))//self.ilu_band
+      key = ('ilu',band,n)
+      ilu = self.lu.get(key)
+      if ilu is None:
+         a = time.time()
+         m_ref = min([band*self.ilu_band + self.ilu_band//2,len(self.mfp)-1])
+         ilu = spilu(self.get_A(m_ref,n),drop_tol=self.ilu_drop_tol,fill_factor=self.ilu_fill_factor)
+         self.lu.put(key,ilu,get_lu_nbytes(ilu),time.time()-a)
+      return ilu
+
+  def get_preconditioner(self,m,n):
+
+      N = self.n_elems
+      if n in self.partner.keys():
+         ilu = self.get_ilu(m,self.partner[n])
+         return LinearOperator((N,N),dtype=np.float64,\
+                matvec = lambda x: ilu.solve(x*self.volumes,trans='T')/self.volumes)
+
+      ilu = self.get_ilu(m,n)
+      return LinearOperator((N,N),dtype=np.float64,matvec = ilu.solve)
+
+  def solve_krylov(self,m,n,B):
+
+      key = self.get_key(m,n)
+      M = self.get_preconditioner(m,n) #before get_A, which shares Master
+      Master = self.get_A(m,n)
+
+      #iterations are counted as applications of A, the same for all methods
+      iterations = [0]
+      def matvec(x):
+          iterations[0] +=1
+          return Master.dot(x)
+      A = LinearOperator(Master.shape,dtype=np.float64,matvec=matvec)
+
+      #initial guess and recycled subspace of the previous BTE iterations, within the LU budget
+      x0 = self.lu.get(('x0',) + key,recycled=True)
+      if self.mode == 'gmres':
+         X,info = call_krylov(gmres,A,B,self.krylov_tol,x0=x0,M=M,restart=50,\
+                  maxiter=max([self.krylov_maxiter//50,1]))
+      elif self.mode == 'gcrotmk':
+         CU = self.lu.get(('cu',) + key,recycled=True)
+         if CU is None: CU = []
+         X,info = call_krylov(gcrotmk,A,B,self.krylov_tol,x0=x0,M=M,\
+                  maxiter=max([self.krylov_maxiter//self.gcrot_dim,1]),\
+                  m=self.gcrot_dim,k=self.recycle_dim,CU=CU)
+         self.lu.put(('cu',) + key,CU,sum([sum([v.nbytes for v in cu if v is not None]) for cu in CU]),recycled=True)
+      else:
+         X,info = call_krylov(bicgstab,A,B,self.krylov_tol,x0=x0,M=M,\
+                  maxiter=self.krylov_maxiter)
+
+      self.stats['krylov_iterations'] += iterations[0]
+      if info == 0:
+         self.stats['krylov_solves'] +=1
+         self.lu.put(('x0',) + key,X,X.nbytes,recycled=True)
+         return X
+
+      #not converged: direct solve
+      self.stats['fallback'] +=1
+      if ('x0',) + key in self.lu: self.lu.remove(('x0',) + key)
+      return None
+
+
+def print_inner_solver(stats):
+
+        print(flush=True)
+        print('                  Inner Solver Diagnostics        ',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
+        print(colored(' KRYLOV SOLVES:    ','green') + str(int(stats[0])),flush=True)
+        print(colored(' ITERATIONS:       ','green') + str(int(stats[1])),flush=True)
+        print(colored(' AVG ITERATIONS:   ','green') + str(round(stats[1]/max([stats[0]+stats[2],1]),2)),flush=True)
+        print(colored(' LU FALLBACKS:     ','green') + str(int(stats[2])),flush=True)
+        print(colored(' LU SOLVES:        ','green') + str(int(stats[3])),flush=True)
+        print(colored(' REFINEMENTS:      ','green') + str(int(stats[4])),flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+import numpy as np
+import scipy.sparse as sp
+from termcolor import colored, cprint
+from mpi4py import MPI
+from .inner_solver import *
+from .freezing import *
+from .workspace import *
+from .anderson import *
+from .dsa import *
+from .angular import *
+from .multiscale import *
+comm = MPI.COMM_WORLD
+
+
+def get_iteration_tools(argv,Gm,D,mfp):
+
+    #Inner solver and accelerators of the fixed-point BTE loop (rta and mfp models)
+    mesh = argv['mesh']
+    n_elems = len(mesh['elems'])
+    Master = sp.csc_matrix((np.arange(len(mesh['im']))+1,(mesh['im'],mesh['jm'])),shape=(n_elems,n_elems),dtype=np.float64)
+    conversion = np.asarray(Master.data-1,np.int)
+
+    tools = {'inner':InnerSolver(Master,conversion,Gm,D,mfp,argv),\
+             'freezer':BinFreezer((argv['n_serial'],argv['n_parallel']),argv),\
+             'work':Workspace(n_elems,mesh['eb'],argv['dim'],argv.setdefault('panel_size',0)),\
+             'anderson':Anderson(argv),\
+             'dsa':DSA(argv),\
+             'angular':AngularTwoLevel(argv,Master,conversion),\
+             'cuts':TransitionCache(argv['n_serial'],argv['n_parallel'],argv)}
+    argv.setdefault('outer_solver','picard')
+
+    return tools
+
+
+def print_iteration_stats(argv,inner,anderson=None,freezer=None,angular=None):
+
+    #Counters of the last BTE iteration, summed over the ranks; returns the frozen/active bins
+    FF = np.zeros(2)
+    if freezer is not None and freezer.enabled:
+      comm.Allreduce([np.array([freezer.n_frozen,argv['mat']['active'][:,argv['rr']].sum()],dtype=np.float64),MPI.DOUBLE],[FF,MPI.DOUBLE],op=MPI.SUM)
+      if argv['verbose'] and comm.rank == 0: print_freezing(FF)
+
+    if argv['lu_memory'] is not None:
+      LU = np.zeros(7)
+      comm.Allreduce([inner.lu.reset_stats(),MPI.DOUBLE],[LU,MPI.DOUBLE],op=MPI.SUM)
+      if argv['verbose'] and comm.rank == 0: print_lu_cache(LU)
+
+    if argv['inner_solver'] in ['gmres','bicgstab','gcrotmk'] or argv['lu_precision'] == 'single':
+      INNER = np.zeros(5)
+      comm.Allreduce([inner.reset_stats(),MPI.DOUBLE],[INNER,MPI.DOUBLE],op=MPI.SUM)
+      if argv['verbose'] and comm.rank == 0: print_inner_solver(INNER)
+
+    if angular is not None and angular.enabled:
+      AN = np.zeros(3)
+      comm.Allreduce([angular.reset_stats(),MPI.DOUBLE],[AN,MPI.DOUBLE],op=MPI.SUM)
+      if argv['verbose'] and comm.rank == 0: print_angular(AN)
+
+    if anderson is not None and anderson.enabled:
+      AA = anderson.reset_stats()
+      if argv['verbose'] and comm.rank == 0: print_anderson(AA)
+
+    return FF
+
+
+def print_multiscale(argv,MM):
+
+        total = argv['n_serial']*argv['n_parallel']
+
+        print(flush=True)
+        print('                  Multiscale Diagnostics        ''',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
+        diff = int(MM[0])/total
+        bal = int(MM[1])/total
+        print(colored(' BTE:              ','green') + str(round((1-diff-bal)*100,2)) + ' %',flush=True)
+        print(colored(' FOURIER:          ','green') + str(round(diff*100,2)) + ' %',flush=True)
+        print(colored(' BALLISTIC:        ','green') + str(round(bal*100,2)) + ' %',flush=True)
+        if argv['multiscale_refresh'] is not None:
+         print(colored(' CACHED WINDOWS:   ','green') + str(int(MM[2])) + '/' + str(argv['n_parallel']),flush=True)
+        if 'fourier_stats' in argv.setdefault('cache',{}).keys():
+         stats = argv['cache']['fourier_stats']
+         print(colored(' FOURIER PASSES:   ','green') + str(stats['passes']) + (' (reused)' if stats['reused'] > 0 else ''),flush=True)
+         stats['passes'] = 0; stats['reused'] = 0
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
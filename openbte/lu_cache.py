@@ -0,0 +1,243 @@
+from __future__ import absolute_import
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve_triangular
+from collections import OrderedDict
+import hashlib
+import scikits.umfpack as um
+import os
+from termcolor import colored, cprint 
+
+
+def get_lu_nbytes(lu,itemsize=8):
+
+    #L+U values and row indices, plus column pointers and permutations
+    return lu.nnz*(itemsize + 4) + 4*lu.shape[0]*4
+
+
+class LUCache(object):
+
+  #Factorizations keyed by (m,n) within a memory budget [bytes].
+  #eviction: 'lru' drops the least recently used factor, 'cost' the cheapest to recompute.
+  #Recycled entries (Krylov initial guesses and subspaces) share the budget but have their own counters.
+
+  def __init__(self,memory=None,eviction='lru'):
+
+      self.memory   = memory
+      self.eviction = eviction
+      self.data     = OrderedDict()
+      self.nbytes   = {}
+      self.cost     = {}
+      self.recycled = set()
+      self.resident = 0
+      self.stats    = dict.fromkeys(['hits','misses','evictions','recycle_hits','recycle_misses','recycle_evictions'],0)
+
+  def __contains__(self,key):
+
+      return key in self.data.keys()
+
+  def __len__(self):
+
+      return len(self.data)
+
+  def get(self,key,recycled=False):
+
+      prefix = 'recycle_' if recycled else ''
+      if key in self.data.keys():
+         self.stats[prefix + 'hits'] +=1
+         self.data.move_to_end(key)
+         return self.data[key]
+
+      self.stats[prefix + 'misses'] +=1
+      return None
+
+  def put(self,key,value,nbytes,cost=0,recycled=False):
+
+      if self.memory is not None and nbytes > self.memory:
+         return value #does not fit at all
+
+      if key in self.data.keys(): self.remove(key)
+
+      while self.memory is not None and self.resident + nbytes > self.memory:
+         victim = self.get_victim()
+         self.stats['recycle_evictions' if victim in self.recycled else 'evictions'] +=1
+         self.remove(victim)
+
+      self.data[key]   = value
+      self.nbytes[key] = nbytes
+      self.cost[key]   = cost
+      self.resident   += nbytes
+      if recycled: self.recycled.add(key)
+      return value
+
+  def get_victim(self):
+
+      if self.eviction == 'cost':
+         return min(self.data.keys(),key=lambda k:self.cost[k])
+
+      return next(iter(self.data.keys()))
+
+  def remove(self,key):
+
+      self.resident -= self.nbytes.pop(key)
+      del self.cost[key]
+      self.recycled.discard(key)
+      return self.data.pop(key)
+
+  def reset_stats(self):
+
+      #counters of the last BTE iteration: factor hits, misses, evictions, resident bytes and
+      #recycled-entry hits, misses, evictions
+      stats = np.array([self.stats[key] for key in ['hits','misses','evictions']] + [self.resident] + \
+              [self.stats[key] for key in ['recycle_hits','recycle_misses','recycle_evictions']],dtype=np.float64)
+      for key in self.stats.keys(): self.stats[key] = 0
+      return stats
+
+
+class StoredLU(object):
+
+  #LU factors read back from a FactorStore: Pr*A*Pc = L*U
+
+  def __init__(self,L,U,perm_r,perm_c):
+
+      self.L = L; self.U = U
+      self.perm_r = perm_r; self.perm_c = perm_c
+      self.shape = L.shape
+      self.nnz = L.nnz + U.nnz
+      self.LT = None
+
+  def solve(self,b,trans='N'):
+
+      if trans == 'N':
+         y = np.empty_like(b); y[self.perm_r] = b
+         y = spsolve_triangular(self.L,y,lower=True,unit_diagonal=True)
+         y = spsolve_triangular(self.U,y,lower=False)
+         return y[self.perm_c]
+
+      if self.LT is None:
+         self.LT = self.L.T.tocsr(); self.UT = self.U.T.tocsr()
+      y = np.empty_like(b); y[self.perm_c] = b
+      y = spsolve_triangular(self.UT,y,lower=True)
+      y = spsolve_triangular(self.LT,y,lower=False,unit_diagonal=True)
+      return y[self.perm_r]
+
+
+class UmfpackFactory(object):
+
+  #A single UMFPACK symbolic analysis (fill-reducing ordering and symbolic factorization)
+  #for all the matrices with the pattern of Master; each factor runs only the numeric phase.
+
+  def __init__(self,Master):
+
+      self.family = 'di' if Master.indices.dtype == np.int32 else 'dl'
+      self.context = um.UmfpackContext(self.family)
+      Master.sort_indices()
+      self.context.symbolic(Master)
+      self.permutation = None
+
+  def factorize(self,A):
+
+      return UmfpackLU(self,A)
+
+  def get_permutation(self,A):
+
+      #row (P) and column (Q) permutations of the factorization of A
+      if self.permutation is None:
+         context = um.UmfpackContext(self.family)
+         context._symbolic = self.context._symbolic
+         L,U,P,Q,R,do_recip = context.lu(A.copy())
+         context.free_numeric()
+         context._symbolic = None #owned by the factory
+         self.permutation = {'P':P,'Q':Q}
+      return self.permutation
+
+
+class UmfpackLU(object):
+
+  #Numeric factorization on the symbolic analysis of an UmfpackFactory
+
+  def __init__(self,factory,A):
+
+      self.A = A.copy() #UMFPACK solves refer to the factorized matrix
+      self.context = um.UmfpackContext(factory.family)
+      self.context._symbolic = factory.context._symbolic
+      self.context.numeric(self.A)
+      self.context._symbolic = None #owned by the factory
+      status,lnz,unz,n_row,n_col,nz_udiag = self.context.funs.get_lunz(self.context._numeric)
+      self.nnz = lnz + unz
+      self.shape = A.shape
+
+  def solve(self,b,trans='N'):
+
+      if b.ndim == 2:
+         return np.array([self.solve(b[:,d],trans) for d in range(b.shape[1])]).T
+
+      return self.context.solve(um.UMFPACK_A if trans == 'N' else um.UMFPACK_At,self.A,b)
+
+
+class FactorStore(object):
+
+  #On-disk factorizations keyed by a content hash of the geometry, the direction and the MFP.
+  #Each factor is stored in two memory-mappable .npy files (indices and values).
+
+  def __init__(self,path,mesh):
+
+      self.path = path
+      if not os.path.isdir(path): os.makedirs(path,exist_ok=True)
+
+      h = hashlib.sha1()
+      for key in ['k','db','i','j','eb']:
+        h.update(np.ascontiguousarray(mesh[key]).tobytes())
+      self.geometry_hash = h.hexdigest()
+      self.stats = {'loaded':0,'saved':0}
+
+  def get_hash(self,direction,mfp):
+
+      h = hashlib.sha1(self.geometry_hash.encode())
+      h.update(np.ascontiguousarray(direction,dtype=np.float64).tobytes())
+      h.update(np.float64(mfp).tobytes())
+      return os.path.join(self.path,h.hexdigest())
+
+  def load(self,filename):
+
+      if not os.path.isfile(filename + '_val.npy'): return None
+
+      ind = np.load(filename + '_ind.npy',mmap_mode='r')
+      val = np.load(filename + '_val.npy',mmap_mode='r')
+      n,nl,nu = ind[:3]
+      ind = ind[3:]
+      L = sp.csr_matrix((val[:nl],ind[:nl],ind[nl:nl+n+1]),shape=(n,n))
+      ind = ind[nl+n+1:]
+      U = sp.csr_matrix((val[nl:],ind[:nu],ind[nu:nu+n+1]),shape=(n,n))
+      ind = ind[nu+n+1:]
+      self.stats['loaded'] +=1
+
+      return StoredLU(L,U,np.array(ind[:n]),np.array(ind[n:]))
+
+  def save(self,filename,lu):
+
+      L = lu.L.tocsr(); U = lu.U.tocsr()
+      n = L.shape[0]
+      ind = np.concatenate(([n,L.nnz,U.nnz],L.indices,L.indptr,U.indices,U.indptr,lu.perm_r,lu.perm_c)).astype(np.int32)
+      val = np.concatenate((L.data,U.data))
+      #write and rename, so that interrupted runs do not leave partial factors
+      for suffix,data in [('_ind',ind),('_val',val)]:
+        np.save(filename + suffix + '_tmp.npy',data)
+        os.replace(filename + suffix + '_tmp.npy',filename + suffix + '.npy')
+      self.stats['saved'] +=1
+
+
+def print_lu_cache(stats):
+
+        print(flush=True)
+        print('                  LU Cache Diagnostics        ',flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
+        print(colored(' HITS:             ','green') + str(int(stats[0])),flush=True)
+        print(colored(' MISSES:           ','green') + str(int(stats[1])),flush=True)
+        print(colored(' EVICTIONS:        ','green') + str(int(stats[2])),flush=True)
+        print(colored(' RESIDENT [MB]:    ','green') + str(round(stats[3]/1e6,2)),flush=True)
+        if stats[4:].sum() > 0:
+         print(colored(' RECYCLED HITS:    ','green') + str(int(stats[4])),flush=True)
+         print(colored(' RECYCLED MISSES:  ','green') + str(int(stats[5])),flush=True)
+         print(colored(' RECYCLED EVICTED: ','green') + str(int(stats[6])),flush=True)
+        print(colored(' -----------------------------------------------------------','green'),flush=True)
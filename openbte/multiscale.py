@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+import numpy as np
+
+
+class TransitionCache(object):
+
+  #Cut points of the multiscale scheme, per direction: the MFP bin where the Fourier test passed
+  #(fourier, -1 if none) and the one where the ballistic test passed (ballistic, n_serial if
+  #none). Between two refreshes (every multiscale_refresh iterations) the window of a known
+  #direction is trusted: only the bins inside it are solved, the edge bins are not solved again
+  #and the ballistic solution is only computed if the window has a ballistic edge. The Fourier
+  #test is still made on the solved bins, so the Fourier edge can move inward; any other change
+  #of the cut points is found at the next refresh, where the full search is made.
+
+  def __init__(self,n_serial,n_parallel,argv):
+
+      self.refresh = argv.setdefault('multiscale_refresh',None)
+      self.enabled = argv['multiscale'] and self.refresh is not None
+      self.n_serial = n_serial
+      self.fourier = -np.ones(n_parallel,dtype=int)
+      self.ballistic = n_serial*np.ones(n_parallel,dtype=int)
+      self.known = np.zeros(n_parallel,dtype=bool)
+      self.full = True
+      self.stats = {'cached':0}
+
+  def start_iteration(self,kk):
+
+      self.full = not self.enabled or kk % self.refresh == 0
+
+  def trusted(self,q):
+
+      return not self.full and self.known[q]
+
+  def start(self,q,idx):
+
+      #first bin of the downward walk: the top of a trusted window
+      if not self.trusted(q): return idx
+      self.stats['cached'] +=1
+
+      return max([self.ballistic[q]-1,0])
+
+  def fourier_edge(self,q,m):
+
+      return self.trusted(q) and m <= self.fourier[q]
+
+  def ballistic_edge(self,q,m):
+
+      return self.trusted(q) and m >= self.ballistic[q]
+
+  def needs_ballistic(self,q):
+
+      return not self.trusted(q) or self.ballistic[q] < self.n_serial
+
+  def update(self,q,fourier,ballistic):
+
+      self.fourier[q] = fourier
+      self.ballistic[q] = ballistic
+      self.known[q] = True
+
+  def reset_stats(self):
+
+      #directions that used a trusted window in the last iteration
+      cached = self.stats['cached']
+      self.stats['cached'] = 0
+      return cached
@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+import numpy as np
+
+
+def combine(base,outputs,y):
+
+    #outputs of base + sum_i y_i*outputs_i
+    return {key:value + sum([y_i*out[key] for y_i,out in zip(y,outputs)]) for key,value in base.items()}
+
+
+def outer_gmres(sweep,x,argv,callback):
+
+    #The outer BTE problem x = G(x) = M x + b, with x = (DeltaT,TB), solved as (I - M)x = b
+    #with restarted GMRES. sweep(x,True) is one pass over all the bins, i.e. G(x), and
+    #sweep(x,False) its linear part M x; both return a dictionary whose entry 'x' is the
+    #new (DeltaT,TB) and whose other entries (kappa, flux, ...) are affine in x as well.
+    #The outputs of each GMRES iterate are therefore combined from those of the basis
+    #vectors, at no extra sweep. callback receives them and returns True to stop.
+
+    restart = argv.setdefault('outer_restart',30)
+
+    base = sweep(x,True)
+    stop = callback(base)
+    while not stop:
+       r = base['x'] - x
+       beta = np.linalg.norm(r)
+       if beta == 0: break
+
+       V = np.zeros((restart+1,len(x)))
+       H = np.zeros((restart+1,restart))
+       V[0] = r/beta
+       outputs = []
+       for k in range(restart):
+          out = sweep(V[k],False)
+          outputs.append(out)
+          w = V[k] - out['x']
+          for i in range(k+1): #modified Gram-Schmidt
+             H[i,k] = np.dot(V[i],w)
+             w -= H[i,k]*V[i]
+          H[k+1,k] = np.linalg.norm(w)
+          breakdown = H[k+1,k] <= 1e-14*beta #the iterate is the exact solution
+          if not breakdown: V[k+1] = w/H[k+1,k]
+
+          rhs = np.zeros(k+2); rhs[0] = beta
+          y = np.linalg.lstsq(H[:k+2,:k+1],rhs,rcond=None)[0]
+          current = combine(base,outputs,y)
+          stop = callback(current) or breakdown
+          if stop: break
+
+       #restart from the last iterate, whose outputs are already known
+       x = x + np.dot(y,V[:k+1])
+       base = current
+
+    return x,base
@@ -4,6 +4,7 @@ from scipy.sparse.linalg import splu
 from termcolor import colored, cprint 
 from .utils import *
 from .fourier import *
+from .iteration import *
 from mpi4py import MPI
 import scipy.sparse as sp
 import time
@@ -99,13 +100,20 @@ def solve_full(**argv):
     Xs_old[:,:] = Xs[:,:].copy()
     TB_old = TB.copy()
 
-    lu = {} 
+    Master = sp.csc_matrix((np.arange(len(mesh['im']))+1,(mesh['im'],mesh['jm'])),shape=(n_elems,n_elems),dtype=np.float64)
+    conversion = np.asarray(Master.data-1,np.int) 
+    inner = InnerSolver(Master,conversion,Gm,D,np.ones(1),argv)
+    anderson = Anderson(argv,distributed=True)
+    n_x = len(argv['rr'])*n_elems
+
     kappa_vec = [fourier['meta'][0]]
     kappa_old = kappa_vec[-1]
     kappa_tot = np.zeros(1)
     kk = 0
     error = 1
     while kk < argv['max_bte_iter'] and error > argv['max_bte_error']:
+
+      if anderson.enabled: x = np.concatenate((Xs[argv['rr']].ravel(),TB))
        
       DeltaTs = np.matmul(mat['B'][argv['rr']],argv['alpha']*Xs+(1-argv['alpha'])*Xs_old)
    
@@ -114,9 +122,6 @@ def solve_full(**argv):
       TBp = np.zeros_like(TB)
       kappa,kappap = np.zeros((2,argv['n_parallel']))
 
-      Master = sp.csc_matrix((np.arange(len(mesh['im']))+1,(mesh['im'],mesh['jm'])),shape=(n_elems,n_elems),dtype=np.float64)
-      conversion = np.asarray(Master.data-1,np.int) 
-
       for n,q in enumerate(argv['rr']):
           
           if len(mesh['eb'])  > 0:
@@ -126,12 +131,7 @@ def solve_full(**argv):
            RHS_tmp =  np.zeros(n_elems)  
 
           #CORE-----
-          Master.data = np.concatenate((Gm[n],D[n]+np.ones(n_elems)))[conversion]
-          B = DeltaTs[n] + P[n] + RHS_tmp 
-          if argv['keep_lu']:
-            Xs[q] = (lu[q] if q in lu.keys() else lu.setdefault(q,sp.linalg.splu(Master))).solve(B)
-          else:  
-            Xs[q] = sp.linalg.spsolve(Master,B,use_umfpack=True)  
+          Xs[q] = inner.solve(0,n,DeltaTs[n],P[n] + RHS_tmp)
           #---------
 
           if len(mesh['eb']) > 0:
@@ -148,7 +148,17 @@ def solve_full(**argv):
       comm.Allreduce([TBp,MPI.DOUBLE],[TB,MPI.DOUBLE],op=MPI.SUM)
       kappa_totp = np.array([np.einsum('q,q->',mat['sigma'][argv['rr'],0],kappa[argv['rr']])])/mat['alpha'][0]
       comm.Allreduce([kappa_totp,MPI.DOUBLE],[kappa_tot,MPI.DOUBLE],op=MPI.SUM)
+
+      if anderson.enabled:
+        #next input from the history of (X,TB): each rank mixes its own directions, TB is counted once
+        weights = np.concatenate((np.ones(n_x),np.ones(len(TB))*(comm.rank == 0)))
+        x = anderson.mix(x,np.concatenate((Xs[argv['rr']].ravel(),TB)),weights)
+        Xs[argv['rr']] = x[:n_x].reshape((len(argv['rr']),n_elems))
+        Xs_old[argv['rr']] = Xs[argv['rr']]
+        TB = x[n_x:]; TB_old = TB.copy()
       comm.Barrier()
+
+      print_iteration_stats(argv,inner,anderson)
   
       kk +=1
       error = abs(kappa_old-kappa_tot[0])/abs(kappa_tot[0])
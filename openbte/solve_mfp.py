@@ -4,6 +4,8 @@ from scipy.sparse.linalg import splu
 from termcolor import colored, cprint 
 from .utils import *
 from .fourier import *
+from .iteration import *
+from .outer_solver import *
 #import deepdish as dd
 from mpi4py import MPI
 import scipy.sparse as sp
@@ -20,35 +22,6 @@ def get_m(Master,data):
     Master.data = data
     return Master
 
-def get_boundary(RHS,eb,n_elems):
-
-
-    if len(eb) > 0:
-     RHS_tmp = np.zeros(n_elems) 
-     np.add.at(RHS_tmp,eb,RHS)
-    else: 
-      return np.zeros(n_elems)
-
-    #for c,i in enumerate(eb): RHS_tmp[i] += RHS[c]
-
-    return RHS_tmp
-
-
-def print_multiscale(argv,MM):
-
-        total = argv['n_serial']*argv['n_parallel']
-
-        print(flush=True)
-        print('                  Multiscale Diagnostics        ''',flush=True)
-        print(colored(' -----------------------------------------------------------','green'),flush=True)
-        diff = int(MM[0])/total
-        bal = int(MM[1])/total
-        print(colored(' BTE:              ','green') + str(round((1-diff-bal)*100,2)) + ' %',flush=True)
-        print(colored(' FOURIER:          ','green') + str(round(diff*100,2)) + ' %',flush=True)
-        print(colored(' BALLISTIC:        ','green') + str(round(bal*100,2)) + ' %',flush=True)
-        print(colored(' -----------------------------------------------------------','green'),flush=True)
-
-
 def solve_mfp(**argv):
 
     mesh    = argv['mesh']
@@ -118,39 +91,101 @@ def solve_mfp(**argv):
     del G,Gp
     #----------------------------------------------------
 
-    lu =  {}
+    #warm start (solution on a coarser mesh) or restart (previous run)
+    guess = argv.setdefault('initial_guess',None)
+    if guess:
+      DeltaT = np.array(guess['temperature'])
+      if len(mesh['db']) > 0 and np.size(guess['TB']) > 0: TB = np.broadcast_to(guess['TB'],np.shape(TB)).copy()
+
     kappa_vec = [fourier['meta'][0]]
+    if guess and 'kappa' in guess.keys(): #restart: the history is resumed
+      kappa_vec = list(guess['kappa'])
     error = 1
-    kk = 0
+    kk = len(kappa_vec)-1
     kappa_tot = np.zeros(1)
-    MM = np.zeros(2)
-    Mp = np.zeros(2)
+    MM = np.zeros(3)
+    Mp = np.zeros(3)
     kappa,kappap = np.zeros((2,argv['n_serial'],argv['n_parallel']))
-    transitionp = np.zeros(argv['n_parallel'])
-    transition = 1e4 * np.ones(argv['n_parallel'])
 
 
     DeltaTold = DeltaT.copy()
 
-    Master = sp.csc_matrix((np.arange(len(mesh['im']))+1,(mesh['im'],mesh['jm'])),shape=(n_elems,n_elems),dtype=np.float64)
-    conversion = np.asarray(Master.data-1,np.int) 
+    tools = get_iteration_tools(argv,Gm,D,mfp)
+    inner,freezer,work = tools['inner'],tools['freezer'],tools['work']
+    anderson,dsa,angular,cuts = tools['anderson'],tools['dsa'],tools['angular'],tools['cuts']
+    panel = work.panel is not None and not argv['multiscale']
+
+    def freeze_bin(m,q,TBp):
+       contributions = {'DeltaT':work.T,'J':work.J}
+       if len(mesh['eb']) > 0:
+        if not argv['thermalizing']:
+         contributions['TB'] = np.zeros_like(TBp)
+         contributions['TB'][m] = work.TB
+        else:
+         contributions['TB'] = work.TB
+       freezer.freeze(m,q,contributions)
+
+    def flush_panel(DeltaTp,TBp,Jp):
+       #reductions of the stored bins as matrix products; frozen bins are then checked one by one
+       bins = work.flush(mesh['kappa_mask'],mat['tc'],GG if len(mesh['eb']) > 0 else None,sigma[:,:,0:argv['dim']],kappap,DeltaTp,TBp,Jp,rows=not argv['thermalizing'])
+       for r,(m,q,kappa_bin) in enumerate(bins):
+          if freezer.converged(m,q,work.panel[r],kappa_bin,kappap[m,q]):
+             work.get_bin(work.panel[r],mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']])
+             freeze_bin(m,q,TBp)
 
     J = np.zeros((n_elems,argv['dim']))
     alpha = 0.75
 
-    if argv.setdefault('load_state',False):
-      a = np.load('state.npz',allow_pickle=True)
-      data = {key:a[key].item() for key in a}['arr_0']
-      TB = data['TB']
-      DeltaT = data['DeltaT']
-      kappa_vec = data['kappa_vec']
-      kk = len(kappa_vec)+1
     kappa_old = kappa_vec[-1]
 
     
     DeltaTB = np.zeros_like(DeltaT)
  
     cache = {}
+
+    if argv['outer_solver'] == 'gmres':
+
+      TB_shape = TB.shape if len(mesh['db']) > 0 else (0,)
+
+      def sweep(x,periodic):
+        #one pass over all the bins at the given (DeltaT,TB); without the periodic term, its linear part
+        DeltaT = x[:n_elems]; TB = x[n_elems:].reshape(TB_shape)
+        DeltaTp = np.zeros(n_elems); TBp = np.zeros_like(TB); Jp = np.zeros_like(J)
+        kappap = np.zeros((argv['n_serial'],argv['n_parallel']))
+        if len(mesh['db']) > 0:
+         RHS = -np.einsum('c,nc->nc',TB,Gbm2) if argv['thermalizing'] else -np.einsum('mc,nc->mnc',TB,Gbm2)
+        for n,q in enumerate(argv['rr']):
+           if not mat['active'][:,q].any(): continue
+           for m in range(argv['n_serial']):
+              if not mat['active'][m,q]: continue
+              R = P[n] if periodic else np.zeros(n_elems)
+              if len(mesh['db']) > 0: R = work.get_boundary(R,RHS[m,n] if not argv['thermalizing'] else RHS[n])
+              X = inner.solve(m,n,DeltaT,R)
+              kappap[m,q] = np.dot(mesh['kappa_mask'],X)
+              work.add_bin(X,mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']],DeltaTp,\
+                           (TBp[m] if not argv['thermalizing'] else TBp) if len(mesh['eb']) > 0 else None,Jp)
+
+        output = {'x':np.zeros_like(x),'J':np.zeros_like(Jp),'kappa':np.zeros_like(kappap)}
+        comm.Allreduce([DeltaTp,MPI.DOUBLE],[output['x'][:n_elems],MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([TBp.ravel(),MPI.DOUBLE],[output['x'][n_elems:],MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([Jp,MPI.DOUBLE],[output['J'],MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([kappap,MPI.DOUBLE],[output['kappa'],MPI.DOUBLE],op=MPI.SUM)
+        return output
+
+      def callback(output):
+        #one sweep per GMRES iteration, reported as a BTE iteration
+        kappa_vec.append(np.einsum('mq,mq->',sigma[:,:,int(mesh['meta'][-1])],output['kappa']))
+        error = abs(kappa_vec[-2]-kappa_vec[-1])/abs(kappa_vec[-1])
+        if argv['verbose'] and comm.rank == 0:
+         print('{0:8d} {1:24.4E} {2:22.4E}'.format(len(kappa_vec)-1,kappa_vec[-1],error),flush=True)
+        return error <= argv['max_bte_error'] or len(kappa_vec) > argv['max_bte_iter']
+
+      x,output = outer_gmres(sweep,np.concatenate((DeltaT,TB.ravel() if len(mesh['db']) > 0 else np.zeros(0))),argv,callback)
+      DeltaT = output['x'][:n_elems]
+      if len(mesh['db']) > 0: TB = output['x'][n_elems:].reshape(TB_shape)
+      J = output['J']
+      kappa = output['kappa']
+      error = 0 #the fixed-point loop below is skipped
     while kk < argv['max_bte_iter'] and error > argv['max_bte_error']:
 
         DeltaTBp = np.zeros_like(DeltaT)
@@ -165,10 +200,11 @@ def solve_mfp(**argv):
         #Multiscale scheme-----------------------------
         diffusive = 0
         bal = 0
-        DeltaTp = np.zeros_like(DeltaT)
-        if len(mesh['db']) > 0: #boundary
-         TBp = np.zeros_like(TB)
-        Jp = np.zeros_like(J)
+        acc = freezer.start(kk,{'DeltaT':DeltaT,'J':J,'TB':TB} if len(mesh['db']) > 0 else {'DeltaT':DeltaT,'J':J})
+        cuts.start_iteration(kk)
+        DeltaTp = acc['DeltaT']
+        TBp = acc['TB'] if len(mesh['db']) > 0 else None #boundary
+        Jp = acc['J']
         kappa_bal,kappa_balp = np.zeros((2,argv['n_parallel']))
         #Sup,Supp   = np.zeros((2,len(mat['kappam'])))
         #Supd,Supdp   = np.zeros((2,len(mat['kappam'])))
@@ -180,53 +216,53 @@ def solve_mfp(**argv):
         else:
          RHS = -np.einsum('mc,nc->mnc',TB,Gbm2) if len(mesh['db']) > 0 else  np.zeros((argv['n_serial'],argv['n_parallel'],0))   
 
+        def get_R(m,n):
+           #periodic + boundary terms
+           return work.get_boundary(P[n],RHS[m,n] if not argv['thermalizing'] else RHS[n])
+
         for n,q in enumerate(argv['rr']):
+
+           if not mat['active'][:,q].any(): continue
            
            #Get ballistic kappa
            if argv['multiscale']:
               kappa_fourier_m =  np.einsum('c,mc->m',mesh['kappa_mask'],tf) - np.einsum('c,m,i,mci->m',mesh['kappa_mask'],mfp,mat['VMFP'][q,0:argv['dim']],tfg)
               
               #Supdp += np.einsum('m,mu->u',kappa_fourier_m,mat['suppression'][:,q,:])*1e9
-              if not argv['thermalizing']:
-               B = DeltaT +  mfp[-1]*(P[n] +  get_boundary(RHS[-1,n],mesh['eb'],n_elems))
-              else: 
-               B = DeltaT +  mfp[-1]*(P[n] +  get_boundary(RHS[n],mesh['eb'],n_elems))
-
-              A = get_m(Master,np.concatenate((mfp[-1]*Gm[n],mfp[-1]*D[n]+np.ones(n_elems)))[conversion])
-              if not argv['keep_lu']:
-                 X_bal = sp.linalg.spsolve(A,B,use_umfpack=True)
-              else:         
-               X_bal = (lu[(-1,n)] if (-1,n) in lu.keys() else lu.setdefault((-1,n),sp.linalg.splu(A))).solve(B)
-
-              kappa_bal = np.dot(mesh['kappa_mask'],X_bal)
+              if cuts.needs_ballistic(q):
+               X_bal = inner.solve(-1,n,DeltaT,get_R(-1,n))
+
+               kappa_bal = np.dot(mesh['kappa_mask'],X_bal)
               #Supbp += kappa_bal*np.einsum('mu->u',mat['suppression'][:,q,:])*1e9
 
               idx = np.argwhere(np.diff(np.sign(kappa_bal*np.ones(argv['n_serial']) - kappa_fourier_m))).flatten()
               if len(idx) == 0: idx = [argv['n_serial']-1]
+              idx = [cuts.start(q,idx[0])]
            else: idx = [argv['n_serial']-1]
+           cut_f = -1; cut_b = argv['n_serial']
 
            for m in range(argv['n_serial'])[idx[0]::-1]:
+
+                if not mat['active'][m,q] or freezer.frozen[m,q]: continue
               
-                if not argv['thermalizing']:
-                 B = DeltaT +  mfp[m]*(P[n] +  get_boundary(RHS[m,n],mesh['eb'],n_elems))
-                else: 
-                 B = DeltaT +  mfp[m]*(P[n] +  get_boundary(RHS[n],mesh['eb'],n_elems))
-                A = get_m(Master,np.concatenate((mfp[m]*Gm[n],mfp[m]*D[n]+np.ones(n_elems)))[conversion])
-                if not argv['keep_lu']:
-                 X = sp.linalg.spsolve(A,B,use_umfpack=True)
-                else:         
-                 X = (lu[(m,n)] if (m,n) in lu.keys() else lu.setdefault((m,n),sp.linalg.splu(A))).solve(B)
+                edge = cuts.fourier_edge(q,m)
+                if not edge: X = inner.solve(m,n,DeltaT,get_R(m,n))
 
-                
-                kappap[m,q] = np.dot(mesh['kappa_mask'],X)
-                tmp = np.dot(mesh['kappa_mask'],X)
+                if panel:
+                 if work.push(X,m,q,kappap[m,q]): flush_panel(DeltaTp,TBp,Jp)
+                 continue
+
+                kappa_bin = kappap[m,q]
+                if not edge:
+                 kappap[m,q] = np.dot(mesh['kappa_mask'],X)
+                 tmp = np.dot(mesh['kappa_mask'],X)
 
                 if argv['multiscale']:
                 
-                 error = abs(tmp - kappa_fourier_m[m])/abs(tmp)
+                 error = 0 if edge else abs(tmp - kappa_fourier_m[m])/abs(tmp)
                  error = 0
-                 if error < argv['multiscale_error_fourier'] :#and m <= transition[q]:
-                  transitionp[q] = m 
+                 if error < argv['multiscale_error_fourier']:
+                  cut_f = m
                   #Vectorize
                   kappap[:m,q] = kappa_fourier_m[:m]
                   diffusive += m+1
@@ -244,38 +280,29 @@ def solve_mfp(**argv):
                   #Supp += np.einsum('m,mu->u',kappap[:m+1,q],mat['suppression'][:m+1,q,:])*1e9
                   break
 
-                DeltaTp += X*mat['tc'][m,q]
-
-                if len(mesh['eb']) > 0:
-                 if not argv['thermalizing']:
-                  np.add.at(TBp[m],np.arange(mesh['eb'].shape[0]),-X[mesh['eb']]*GG[m,q])
-                 else: 
-                  np.add.at(TBp,np.arange(mesh['eb'].shape[0]),-X[mesh['eb']]*GG[m,q])
-
-                Jp += np.einsum('c,j->cj',X,sigma[m,q,0:argv['dim']])*1e-18
+                work.add_bin(X,mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']],DeltaTp,\
+                             (TBp[m] if not argv['thermalizing'] else TBp) if len(mesh['eb']) > 0 else None,Jp)
                 #Supp += kappap[m,q]*mat['suppression'][m,q,:]*1e9
+
+                if freezer.converged(m,q,X,kappa_bin,kappap[m,q]): freeze_bin(m,q,TBp)
                 
  
            for m in range(argv['n_serial'])[idx[0]+1:]:
+
+               if not mat['active'][m,q]: continue
  
-               if not argv['thermalizing']:
-                 B = DeltaT +  mfp[m]*(P[n] +  get_boundary(RHS[m,n],mesh['eb'],n_elems))
-               else: 
-                 B = DeltaT +  mfp[m]*(P[n] +  get_boundary(RHS[n],mesh['eb'],n_elems))
-
-               A = get_m(Master,np.concatenate((mfp[m]*Gm[n],mfp[m]*D[n]+np.ones(n_elems)))[conversion])
-               if not argv['keep_lu']:
-                 X = sp.linalg.spsolve(A,B,use_umfpack=True)
-               else:         
-                 X = (lu[(m,n)] if (m,n) in lu.keys() else lu.setdefault((m,n),sp.linalg.splu(A))).solve(B)
+               edge = cuts.ballistic_edge(q,m)
+               if not edge:
+                X = inner.solve(m,n,DeltaT,get_R(m,n))
                  
-               kappap[m,q] = np.dot(mesh['kappa_mask'],X)
+                kappap[m,q] = np.dot(mesh['kappa_mask'],X)
 
-               error_bal = abs(kappap[m,q] - kappa_bal)/abs(kappap[m,q])
-               if error_bal < argv['multiscale_error_ballistic'] and \
+               error_bal = 0 if edge else abs(kappap[m,q] - kappa_bal)/abs(kappap[m,q])
+               if edge or error_bal < argv['multiscale_error_ballistic'] and \
                   abs(kappap[m-1,q] - kappa_bal)/abs(kappap[m-1,q]) < argv['multiscale_error_ballistic'] and  m > int(len(mat['mfp_sampled'])/2):
 
                    kappap[m:,q] = kappa_bal
+                   cut_b = m
                    bal += argv['n_serial']-m
                    DeltaTp += X_bal*np.sum(mat['tc'][m:,q])
 
@@ -288,32 +315,28 @@ def solve_mfp(**argv):
                    #Supp += np.einsum('m,mu->u',kappap[m:,q],mat['suppression'][m:,q,:])*1e9
                    break
                
-               DeltaTp += X*mat['tc'][m,q]
-
-               
                #for c,i in enumerate(mesh['eb']): TBp[m,c] -= X[i]*GG[m,q,c]
-               if len(mesh['eb']) > 0:
-                if not argv['thermalizing']:
-                 np.add.at(TBp[m],np.arange(mesh['eb'].shape[0]),-X[mesh['eb']]*GG[m,q])
-                else: 
-                 np.add.at(TBp,np.arange(mesh['eb'].shape[0]),-X[mesh['eb']]*GG[m,q])
-                  
-
-               Jp += np.einsum('c,j->cj',X,sigma[m,q,0:argv['dim']])*1e-18
+               work.add_bin(X,mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']],DeltaTp,\
+                            (TBp[m] if not argv['thermalizing'] else TBp) if len(mesh['eb']) > 0 else None,Jp)
                #Supp += kappap[m,q]*mat['suppression'][m,q,:]*1e9
+
+           if argv['multiscale']: cuts.update(q,cut_f,cut_b)
           
 
+        if panel: flush_panel(DeltaTp,TBp,Jp)
+
         Mp[0] = diffusive
         Mp[1] = bal
+        Mp[2] = cuts.reset_stats()
         comm.Barrier()
 
         DeltaTold = DeltaT.copy()
+        TB_old = TB.copy() if len(mesh['eb']) > 0 else np.zeros(0)
         comm.Allreduce([DeltaTp,MPI.DOUBLE],[DeltaT,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([DeltaTBp,MPI.DOUBLE],[DeltaTB,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([Jp,MPI.DOUBLE],[J,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([kappap,MPI.DOUBLE],[kappa,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([Mp,MPI.DOUBLE],[MM,MPI.DOUBLE],op=MPI.SUM)
-        comm.Allreduce([transitionp,MPI.DOUBLE],[transition,MPI.DOUBLE],op=MPI.SUM)
         if len(mesh['eb']) > 0:
          comm.Allreduce([TBp,MPI.DOUBLE],[TB,MPI.DOUBLE],op=MPI.SUM)
         #comm.Allreduce([Supp,MPI.DOUBLE],[Sup,MPI.DOUBLE],op=MPI.SUM)
@@ -323,11 +346,29 @@ def solve_mfp(**argv):
         kappa_totp = np.array([np.einsum('mq,mq->',sigma[:,argv['rr'],int(mesh['meta'][-1])],kappa[:,argv['rr']])])
         comm.Allreduce([kappa_totp,MPI.DOUBLE],[kappa_tot,MPI.DOUBLE],op=MPI.SUM)
 
-        if argv.setdefault('save_state',False):
-            save_data('state',{'DeltaT':DeltaT,'TB':TB,'kappa_vec':kappa_vec})   
+        if angular.enabled:
+          #coarse-angle correction of the sweep
+          eT,eB = angular.correct(DeltaT - DeltaTold,TB - TB_old if len(mesh['eb']) > 0 else np.zeros(0),mat['active'][:,argv['rr']].sum() - freezer.n_frozen)
+          DeltaT += eT
+          if len(mesh['eb']) > 0: TB += eB
+
+        if dsa.enabled and not angular.enabled:
+          #diffusion correction of the sweep
+          e = dsa.correct(DeltaT,DeltaTold)
+          DeltaT += e
+          if len(mesh['eb']) > 0: TB += e[mesh['eb']]
+
+        if anderson.enabled:
+          #next input from the history of (DeltaT,TB); it replaces the boost relaxation
+          x = anderson.mix(np.concatenate((DeltaTold,TB_old.ravel())),np.concatenate((DeltaT,TB.ravel() if len(mesh['eb']) > 0 else TB_old)))
+          DeltaT = x[:n_elems]
+          if len(mesh['eb']) > 0: TB = x[n_elems:].reshape(TB.shape)
+          DeltaTold = DeltaT.copy()
 
         if argv['multiscale'] and comm.rank == 0: print_multiscale(argv,MM) 
 
+        FF = print_iteration_stats(argv,inner,anderson,freezer,angular)
+
         kk +=1
         error = abs(kappa_old-kappa_tot[0])/abs(kappa_tot[0])
         kappa_old = kappa_tot[0]
@@ -335,13 +376,24 @@ def solve_mfp(**argv):
         if argv['verbose'] and comm.rank == 0:   
          print('{0:8d} {1:24.4E} {2:22.4E}'.format(kk,kappa_vec[-1],error),flush=True)
 
+        if argv.setdefault('save_state',False):
+          save_checkpoint(argv,DeltaT,TB if len(mesh['db']) > 0 else np.zeros(0),kappa_vec)
+
+        if FF[0] > 0 and error <= argv['max_bte_error']:
+          #confirm convergence with all the bins
+          freezer.force_refresh = True
+          error = 1
+
     if argv['verbose'] and comm.rank == 0:
       print(colored(' -----------------------------------------------------------','green'),flush=True)
 
 
    
 
-    output =  {'kappa':kappa_vec,'temperature':DeltaT,'flux':J,'kappa_mode':kappa-np.dot(mesh['kappa_mask'],DeltaT),'pseudo':compute_grad(DeltaTB,argv),'GradT':GradT,'DeltaT':DeltaTB}
+    output =  {'kappa':kappa_vec,'temperature':DeltaT,'TB':TB if len(mesh['db']) > 0 else np.zeros(0),'flux':J,'kappa_mode':kappa-np.dot(mesh['kappa_mask'],DeltaT),'pseudo':compute_grad(DeltaTB,argv),'GradT':GradT,'DeltaT':DeltaTB}
+
+    if argv['lu_backend'] == 'umfpack':
+       output.update({'lu_permutation':inner.get_permutation()})
     #if argv['multiscale']:   
     #    output.update({'suppression_diffusive':Supd,'suppression_ballistic':Supb})
 
@@ -4,6 +4,8 @@ from scipy.sparse.linalg import splu
 from termcolor import colored, cprint 
 from .utils import *
 from .fourier import *
+from .iteration import *
+from .outer_solver import *
 #import deepdish as dd
 from mpi4py import MPI
 import scipy.sparse as sp
@@ -18,35 +20,6 @@ def get_m(Master,data):
     Master.data = data
     return Master
 
-def get_boundary(RHS,eb,n_elems):
-
-    if len(eb)  > 0:
-     RHS_tmp = np.zeros(n_elems) 
-     np.add.at(RHS_tmp,eb,RHS)
-    else: 
-      return np.zeros(n_elems)  
-
-    #for c,i in enumerate(eb): RHS_tmp[i] += RHS[c]
-
-    return RHS_tmp
-
-
-def print_multiscale(argv,MM):
-
-        total = argv['n_serial']*argv['n_parallel']
-
-        print(flush=True)
-        print('                  Multiscale Diagnostics        ''',flush=True)
-        print(colored(' -----------------------------------------------------------','green'),flush=True)
-        diff = int(MM[0])/total
-        bal = int(MM[1])/total
-        print(colored(' BTE:              ','green') + str(round((1-diff-bal)*100,2)) + ' %',flush=True)
-        print(colored(' FOURIER:          ','green') + str(round(diff*100,2)) + ' %',flush=True)
-        print(colored(' BALLISTIC:        ','green') + str(round(bal*100,2)) + ' %',flush=True)
-        print(colored(' -----------------------------------------------------------','green'),flush=True)
-
-
-
 def solve_rta(**argv):
 
     mesh    = argv['mesh']
@@ -105,24 +78,39 @@ def solve_rta(**argv):
     del G,Gp
     #----------------------------------------------------
 
-    lu =  {}
+    #warm start (solution on a coarser mesh) or restart (previous run)
+    guess = argv.setdefault('initial_guess',None)
+    if guess:
+      DeltaT = np.array(guess['temperature'])
+      if len(mesh['db']) > 0 and np.size(guess['TB']) > 0: TB = np.broadcast_to(guess['TB'],np.shape(TB)).copy()
+
     kappa_vec = [fourier['meta'][0]]
+    if guess and 'kappa' in guess.keys(): #restart: the history is resumed
+      kappa_vec = list(guess['kappa'])
     kappa_old = kappa_vec[-1]
     error = 1
-    kk = 0
+    kk = len(kappa_vec)-1
     kappa_tot = np.zeros(1)
-    MM = np.zeros(2)
-    Mp = np.zeros(2)
+    MM = np.zeros(3)
+    Mp = np.zeros(3)
     kappa,kappap = np.zeros((2,argv['n_serial'],argv['n_parallel']))
     kappaf,kappap_f = np.zeros((2,argv['n_serial'],argv['n_parallel']))
     kappab,kappap_b = np.zeros((2,argv['n_serial'],argv['n_parallel']))
-    transitionp = np.zeros(argv['n_parallel'])
-    transition = 1e4 * np.ones(argv['n_parallel'])
 
 
     #T_old = np.tile(DeltaT,(argv['n_parallel'],argv['n_serial']))
-    Master = sp.csc_matrix((np.arange(len(mesh['im']))+1,(mesh['im'],mesh['jm'])),shape=(n_elems,n_elems),dtype=np.float64)
-    conversion = np.asarray(Master.data-1,np.int) 
+    tools = get_iteration_tools(argv,Gm,D,mfp)
+    inner,freezer,work = tools['inner'],tools['freezer'],tools['work']
+    anderson,dsa,angular,cuts = tools['anderson'],tools['dsa'],tools['angular'],tools['cuts']
+    panel = work.panel is not None and not argv['multiscale']
+
+    def flush_panel(DeltaTp,TBp,Jp):
+       #reductions of the stored bins as matrix products; frozen bins are then checked one by one
+       bins = work.flush(mesh['kappa_mask'],mat['tc'],GG if len(mesh['eb']) > 0 else None,sigma[:,:,0:argv['dim']],kappap,DeltaTp,TBp,Jp)
+       for r,(m,q,kappa_bin) in enumerate(bins):
+          if freezer.converged(m,q,work.panel[r],kappa_bin,kappap[m,q]):
+             work.get_bin(work.panel[r],mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']])
+             freezer.freeze(m,q,{'DeltaT':work.T,'TB':work.TB,'J':work.J})
 
     J = np.zeros((n_elems,argv['dim']))
 
@@ -130,6 +118,47 @@ def solve_rta(**argv):
     a1 = []
     a2 = []
     cache = {}
+
+    if argv['outer_solver'] == 'gmres':
+
+      def sweep(x,periodic):
+        #one pass over all the bins at the given (DeltaT,TB); without the periodic term, its linear part
+        DeltaT = x[:n_elems]; TB = x[n_elems:]
+        DeltaTp = np.zeros(n_elems); TBp = np.zeros_like(TB); Jp = np.zeros_like(J)
+        kappap = np.zeros((argv['n_serial'],argv['n_parallel']))
+        RHS = -np.einsum('c,nc->nc',TB,Gbm2) if len(mesh['db']) > 0 else np.zeros((len(argv['rr']),0))
+        for n,q in enumerate(argv['rr']):
+           if not mat['active'][:,q].any(): continue
+           R = work.get_boundary(P[n] if periodic else np.zeros(n_elems),RHS[n])
+           for m in range(argv['n_serial']):
+              if not mat['active'][m,q]: continue
+              X = inner.solve(m,n,DeltaT,R)
+              kappap[m,q] = np.dot(mesh['kappa_mask'],X)
+              work.add_bin(X,mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']],DeltaTp,TBp,Jp)
+
+        output = {'x':np.zeros_like(x),'J':np.zeros_like(Jp),'kappa':np.zeros_like(kappap)}
+        comm.Allreduce([DeltaTp,MPI.DOUBLE],[output['x'][:n_elems],MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([TBp,MPI.DOUBLE],[output['x'][n_elems:],MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([Jp,MPI.DOUBLE],[output['J'],MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([kappap,MPI.DOUBLE],[output['kappa'],MPI.DOUBLE],op=MPI.SUM)
+        return output
+
+      def callback(output):
+        #one sweep per GMRES iteration, reported as a BTE iteration
+        kappa_vec.append(np.einsum('mq,mq->',sigma[:,:,int(mesh['meta'][-1])],output['kappa']))
+        error = abs(kappa_vec[-2]-kappa_vec[-1])/abs(kappa_vec[-1])
+        if argv['verbose'] and comm.rank == 0:
+         print('{0:8d} {1:24.4E} {2:22.4E}'.format(len(kappa_vec)-1,kappa_vec[-1],error),flush=True)
+        return error <= argv['max_bte_error'] or len(kappa_vec) > argv['max_bte_iter']
+
+      x,output = outer_gmres(sweep,np.concatenate((DeltaT,TB.ravel())),argv,callback)
+      DeltaT_old = x[:n_elems]
+      DeltaT = output['x'][:n_elems]
+      if len(mesh['db']) > 0: TB = output['x'][n_elems:].reshape(TB.shape)
+      J = output['J']
+      kappa = output['kappa']
+      error = 0 #the fixed-point loop below is skipped
+
     while kk < argv['max_bte_iter'] and error > argv['max_bte_error']:
 
         a = time.time()
@@ -137,9 +166,11 @@ def solve_rta(**argv):
         #Multiscale scheme-----------------------------
         diffusive = 0
         bal = 0
-        DeltaTp = np.zeros_like(DeltaT)
-        TBp = np.zeros_like(TB)
-        Jp = np.zeros_like(J)
+        acc = freezer.start(kk,{'DeltaT':DeltaT,'TB':TB,'J':J})
+        cuts.start_iteration(kk)
+        DeltaTp = acc['DeltaT']
+        TBp = acc['TB']
+        Jp = acc['J']
         kappa_bal,kappa_balp = np.zeros((2,argv['n_parallel']))
         #Sup,Supp   = np.zeros((2,len(mat['kappam'])))
         #Supd,Supdp   = np.zeros((2,len(mat['kappam'])))
@@ -150,6 +181,10 @@ def solve_rta(**argv):
         DeltaT2 = DeltaT - (max(DeltaT)+min(DeltaT))/2.0
         tt = {'mesh':mesh}
         for n,q in enumerate(argv['rr']):
+
+           if not mat['active'][:,q].any(): continue
+
+           R = work.get_boundary(P[n],RHS[n])
            
            #Get ballistic kappa
            if argv['multiscale']:
@@ -159,15 +194,11 @@ def solve_rta(**argv):
               #kappap_f[:,q] =   - np.einsum('c,m,i,mci->m',mesh['kappa_mask'],mfp,mat['VMFP'][q,0:argv['dim']],tfg)
               #Supdp += np.einsum('m,mu->u',kappa_fourier_m,mat['suppression'][:,q,:])*1e9
 
-              B = DeltaT +  mfp[-1]*(P[n] +get_boundary(RHS[n],mesh['eb'],n_elems))
-              A = get_m(Master,np.concatenate((mfp[-1]*Gm[n],mfp[-1]*D[n]+np.ones(n_elems)))[conversion])
-              if not argv['keep_lu']:
-                  X_bal = sp.linalg.spsolve(A,B,use_umfpack=True)
-              else: 
-                  X_bal = (lu[(-1,n)] if (-1,n) in lu.keys() else lu.setdefault((-1,n),sp.linalg.splu(A))).solve(B)
+              if cuts.needs_ballistic(q):
+               X_bal = inner.solve(-1,n,DeltaT,R)
 
-              #kappa_bal = np.dot(mesh['kappa_mask'],X_bal)
-              kappap_b[:,q] = np.dot(mesh['kappa_mask'],X_bal)
+               #kappa_bal = np.dot(mesh['kappa_mask'],X_bal)
+               kappap_b[:,q] = np.dot(mesh['kappa_mask'],X_bal)
 
               #idx = np.argwhere(np.diff(np.sign(kappa_bal*np.ones(argv['n_serial']) - kappap_f[:,q]))).flatten()+1
               idx = np.argwhere(np.diff(np.sign(kappap_b[:,q] - kappap_f[:,q]))).flatten()+1
@@ -180,31 +211,33 @@ def solve_rta(**argv):
                  idx = idx[0]
 
               idx = min([idx,argv['n_serial']])
+              idx = cuts.start(q,idx)
 
            else: idx = argv['n_serial']-1
+           cut_f = -1; cut_b = argv['n_serial']
 
            #idx = argv['n_serial']-1
            for m in range(argv['n_serial'])[idx::-1]:
+
+                 if not mat['active'][m,q] or freezer.frozen[m,q]: continue
                  
-                 B = DeltaT +  mfp[m]*(P[n] +get_boundary(RHS[n],mesh['eb'],n_elems))
-                 A = get_m(Master,np.concatenate((mfp[m]*Gm[n],mfp[m]*D[n]+np.ones(n_elems)))[conversion])
-                 if not argv['keep_lu']:
-                  X = sp.linalg.spsolve(A,B,use_umfpack=True)
-                 else: 
-                  X = (lu[(m,n)] if (m,n) in lu.keys() else lu.setdefault((m,n),sp.linalg.splu(A))).solve(B)
-
-                 kappap[m,q] = np.dot(mesh['kappa_mask'],X)
+                 edge = cuts.fourier_edge(q,m)
+                 if not edge: X = inner.solve(m,n,DeltaT,R)
+
+                 if panel:
+                  if work.push(X,m,q,kappap[m,q]): flush_panel(DeltaTp,TBp,Jp)
+                  continue
+
+                 kappa_bin = kappap[m,q]
+                 if not edge: kappap[m,q] = np.dot(mesh['kappa_mask'],X)
                  #kappa2p[m,q] = np.dot(mesh['kappa_mask'],X-DeltaT)
                  if argv['multiscale']:
                   #error = abs(kappap[m,q] - kappa_fourier_m[m])/abs(kappap[m,q])
-                  error = abs(kappap[m,q] - kappap_f[m,q])/abs(kappap[m,q])
-                  if error < argv['multiscale_error_fourier'] and m <= transition[q]:
+                  error = 0 if edge else abs(kappap[m,q] - kappap_f[m,q])/abs(kappap[m,q])
+                  if error < argv['multiscale_error_fourier']:
 
                    fourier = True   
-                   if argv.setdefault('transition',False):
-                       transitionp[q] = m
-                   else:
-                       transitionp[q] = 1e4
+                   cut_f = m
 
                    #Vectorize
                    #kappap[:m+1,q] = kappa_fourier_m[:m+1]
@@ -219,35 +252,32 @@ def solve_rta(**argv):
                    Jp += np.einsum('mc,mj->cj',Xm,sigma[:m+1,q,0:argv['dim']])*1e-18
                    break
 
-                 DeltaTp += X*mat['tc'][m,q]
-
-                 if len(mesh['eb']) > 0:
-                  np.add.at(TBp,np.arange(mesh['eb'].shape[0]),-X[mesh['eb']]*GG[m,q])
-
-                 Jp += np.einsum('c,j->cj',X,sigma[m,q,0:argv['dim']])*1e-18
+                 work.add_bin(X,mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']],DeltaTp,TBp,Jp)
                  #Supp += kappap[m,q]*mat['suppression'][m,q,:]*1e9
+
+                 if freezer.converged(m,q,X,kappa_bin,kappap[m,q]):
+                  freezer.freeze(m,q,{'DeltaT':work.T,'TB':work.TB,'J':work.J})
                 
  
            for m in range(argv['n_serial'])[idx+1:]:
 
+               if not mat['active'][m,q]: continue
 
-               B = DeltaT +  mfp[m]*(P[n] +get_boundary(RHS[n],mesh['eb'],n_elems))
-               A = get_m(Master,np.concatenate((mfp[m]*Gm[n],mfp[m]*D[n]+np.ones(n_elems)))[conversion])
-               if not argv['keep_lu']:
-                  X = sp.linalg.spsolve(A,B,use_umfpack=True)
-               else: 
-                  X = (lu[(m,n)] if (m,n) in lu.keys() else lu.setdefault((m,n),sp.linalg.splu(A))).solve(B)
+               edge = cuts.ballistic_edge(q,m)
+               if not edge:
+                X = inner.solve(m,n,DeltaT,R)
 
-               kappap[m,q] = np.dot(mesh['kappa_mask'],X)
+                kappap[m,q] = np.dot(mesh['kappa_mask'],X)
 
                #error_bal = abs(kappap[m,q] - kappa_bal)/abs(kappap[m,q])
-               error_bal = abs(kappap[m,q] - kappap_b[m,q])/abs(kappap[m,q])
-               if error_bal < argv['multiscale_error_ballistic'] and \
+               error_bal = 0 if edge else abs(kappap[m,q] - kappap_b[m,q])/abs(kappap[m,q])
+               if edge or error_bal < argv['multiscale_error_ballistic'] and \
                    abs(kappap[m-1,q] - kappap_b[m-1,q])/abs(kappap[m-1,q]) < argv['multiscale_error_ballistic'] and  m > int(len(mat['mfp_sampled'])/2):
                   #abs(kappap[m-1,q] - kappa_bal)/abs(kappap[m-1,q]) < argv['multiscale_error_ballistic'] and  m > int(len(mat['mfp_sampled'])/2):
 
                    #kappap[m:,q] = kappa_bal
                    kappap[m:,q] = kappap_b[m:,q]
+                   cut_b = m
                    bal += argv['n_serial']-m
                    DeltaTp += X_bal*np.sum(mat['tc'][m:,q])
 
@@ -257,18 +287,19 @@ def solve_rta(**argv):
                    #Supp += np.einsum('m,mu->u',kappap[m:,q],mat['suppression'][m:,q,:])*1e9
                    break
 
-               DeltaTp += X*mat['tc'][m,q]
-               
-               if len(mesh['eb'])>0:
-                np.add.at(TBp,np.arange(mesh['eb'].shape[0]),-X[mesh['eb']]*GG[m,q])
-
-               Jp += np.einsum('c,j->cj',X,sigma[m,q,0:argv['dim']])*1e-18
+               work.add_bin(X,mat['tc'][m,q],GG[m,q] if len(mesh['eb']) > 0 else None,sigma[m,q,0:argv['dim']],DeltaTp,TBp,Jp)
                #Supp += kappap[m,q]*mat['suppression'][m,q,:]*1e9
+
+           if argv['multiscale']: cuts.update(q,cut_f,cut_b)
           
 
+        if panel: flush_panel(DeltaTp,TBp,Jp)
+
         Mp[0] = diffusive
         Mp[1] = bal
+        Mp[2] = cuts.reset_stats()
         DeltaT_old = DeltaT.copy()
+        TB_old = TB.copy()
         comm.Barrier()
 
         comm.Allreduce([DeltaTp,MPI.DOUBLE],[DeltaT,MPI.DOUBLE],op=MPI.SUM)
@@ -277,7 +308,6 @@ def solve_rta(**argv):
         comm.Allreduce([kappap_b,MPI.DOUBLE],[kappab,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([kappap_f,MPI.DOUBLE],[kappaf,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([Mp,MPI.DOUBLE],[MM,MPI.DOUBLE],op=MPI.SUM)
-        comm.Allreduce([transitionp,MPI.DOUBLE],[transition,MPI.DOUBLE],op=MPI.SUM)
         comm.Allreduce([TBp,MPI.DOUBLE],[TB,MPI.DOUBLE],op=MPI.SUM)
         #comm.Allreduce([Supp,MPI.DOUBLE],[Sup,MPI.DOUBLE],op=MPI.SUM)
         #comm.Allreduce([Supdp,MPI.DOUBLE],[Supd,MPI.DOUBLE],op=MPI.SUM)
@@ -285,9 +315,28 @@ def solve_rta(**argv):
         kappa_totp = np.array([np.einsum('mq,mq->',sigma[:,argv['rr'],int(mesh['meta'][-1])],kappa[:,argv['rr']])])
         comm.Allreduce([kappa_totp,MPI.DOUBLE],[kappa_tot,MPI.DOUBLE],op=MPI.SUM)
 
+        if angular.enabled:
+          #coarse-angle correction of the sweep
+          eT,eB = angular.correct(DeltaT - DeltaT_old,TB - TB_old if len(mesh['eb']) > 0 else np.zeros(0),mat['active'][:,argv['rr']].sum() - freezer.n_frozen)
+          DeltaT += eT
+          if len(mesh['eb']) > 0: TB += eB
+
+        if dsa.enabled and not angular.enabled:
+          #diffusion correction of the sweep
+          e = dsa.correct(DeltaT,DeltaT_old)
+          DeltaT += e
+          if len(mesh['eb']) > 0: TB += e[mesh['eb']]
+
+        if anderson.enabled:
+          #next input from the history of (DeltaT,TB)
+          x = anderson.mix(np.concatenate((DeltaT_old,TB_old.ravel())),np.concatenate((DeltaT,TB.ravel())))
+          DeltaT = x[:n_elems]; TB = x[n_elems:].reshape(TB.shape)
+
 
         if argv['multiscale'] and comm.rank == 0: print_multiscale(argv,MM) 
 
+        FF = print_iteration_stats(argv,inner,anderson,freezer,angular)
+
         kk +=1
         error = abs(kappa_old-kappa_tot[0])/abs(kappa_tot[0])
         kappa_old = kappa_tot[0]
@@ -295,6 +344,14 @@ def solve_rta(**argv):
         if argv['verbose'] and comm.rank == 0:   
          print('{0:8d} {1:24.4E} {2:22.4E}'.format(kk,kappa_vec[-1],error),flush=True)
 
+        if argv.setdefault('save_state',False):
+          save_checkpoint(argv,DeltaT,TB if len(mesh['db']) > 0 else np.zeros(0),kappa_vec)
+
+        if FF[0] > 0 and error <= argv['max_bte_error']:
+          #confirm convergence with all the bins
+          freezer.force_refresh = True
+          error = 1
+
     if argv['verbose'] and comm.rank == 0:
       print(colored(' -----------------------------------------------------------','green'),flush=True)
 
@@ -304,9 +361,12 @@ def solve_rta(**argv):
     #DeltaT2 = DeltaT - (max(DeltaT)+min(DeltaT))/2.0
     #print(min(DeltaT2),max(DeltaT2))
 
-    output =  {'kappa':kappa_vec,'temperature':DeltaT,'flux':J,'kappa_mode':kappa-np.dot(mesh['kappa_mask'],DeltaT_old),'kappa_mode_f':kappaf-np.dot(mesh['kappa_mask'],DeltaT_old),\
+    output =  {'kappa':kappa_vec,'temperature':DeltaT,'TB':TB,'flux':J,'kappa_mode':kappa-np.dot(mesh['kappa_mask'],DeltaT_old),'kappa_mode_f':kappaf-np.dot(mesh['kappa_mask'],DeltaT_old),\
               'kappa_mode_b':kappab-np.dot(mesh['kappa_mask'],DeltaT_old)}
     #output =  {'kappa':kappa_vec,'temperature':DeltaT,'flux':J,'kappa_mode':kappa}#,'suppression':Sup}
+
+    if argv['lu_backend'] == 'umfpack':
+       output.update({'lu_permutation':inner.get_permutation()})
     #if argv['multiscale']:   
     #    output.update({'suppression_diffusive':Supd})
     #    output.update({'suppression_diffusive':Supd,'suppression_ballistic':Supb})
@@ -327,3 +387,136 @@ def solve_rta(**argv):
 
 
 
+
+
+def solve_rta_tensor(**argv):
+
+    #One column per applied gradient (x,y[,z]): all the gradients share the factorizations.
+    #Requires a geometry generated with tensor=True; only the axes with periodic flux sides
+    #(tensor_directions) are included.
+    mesh    = argv['mesh']
+    mat     = argv['mat']
+    fourier = argv['fourier']
+    n_elems = len(mesh['elems'])
+    dim     = argv['dim']
+    mfp = mat['mfp_sampled']*1e9
+    sigma = mat['sigma']*1e9
+    directions = get_tensor_directions(mesh)
+    n_dir = len(directions)
+    meshes = [get_direction_mesh(mesh,d) for d in directions]
+
+    if comm.rank == 0 and argv['verbose']:
+       print(flush=True)
+       print('      Iter    Thermal Conductivity [W/m/K] (xx,yy,..)      Error ''',flush=True)
+       print(colored(' -----------------------------------------------------------','green'),flush=True)
+
+    if len(mesh['db']) > 0:
+      if comm.rank == 0: 
+       Gb   = np.einsum('mqj,jn->mqn',mat['sigma'],mesh['db'],optimize=True)
+       Gbp2 = Gb.clip(min=0);
+       with np.errstate(divide='ignore', invalid='ignore'):
+          tot = 1/Gb.clip(max=0).sum(axis=0).sum(axis=0); tot[np.isinf(tot)] = 0
+       data = {'GG': np.einsum('mqs,s->mqs',Gbp2,tot)}
+       del tot, Gbp2
+      else: data = None
+      GG = create_shared_memory_dict(data)['GG']
+ 
+    #Bulk properties---
+    G = np.einsum('qj,jn->qn',mat['VMFP'][argv['rr']],mesh['k'],optimize=True)
+    Gp = G.clip(min=0); Gm = G.clip(max=0)
+    D = np.zeros((len(argv['rr']),len(mesh['elems'])))
+    np.add.at(D.T,mesh['i'],Gp.T)
+
+    DeltaT = fourier['temperature_fourier_tensor'].T.copy()
+    #--------------------------
+
+    #---boundary----------------------
+    TB = np.zeros((len(mesh['eb']),n_dir))
+    if len(mesh['db']) > 0: #boundary
+     tmp = np.einsum('rj,jn->rn',mat['VMFP'][argv['rr']],mesh['db'],optimize=True)  
+     Gbp2 = tmp.clip(min=0); Gbm2 = tmp.clip(max=0);
+     np.add.at(D.T,mesh['eb'],Gbp2.T)
+     TB = DeltaT[mesh['eb']]
+
+    #Periodic---
+    P = np.zeros((len(argv['rr']),n_elems,n_dir))
+    for d,view in enumerate(meshes):
+     sss = np.asarray(view['pp'][:,0],dtype=int)
+     np.add.at(P[:,:,d].T,mesh['i'][sss],-(view['pp'][:,1]*Gm[:,sss]).T)
+    del G,Gp
+    #----------------------------------------------------
+
+    #flux along i (columns of kappa_mask) for a unit gradient along j
+    kappa_mask = np.array([view['kappa_mask'] for view in meshes]).T
+    scale = np.array([[mesh['size'][j]/mesh['size'][i] for j in directions] for i in directions])
+
+    kappa_vec = [np.diag(fourier['kappa_fourier_tensor'])]
+    kappa_old = kappa_vec[-1]
+    error = 1
+    kk = 0
+    kappa_tot = np.zeros((n_dir,n_dir))
+    kappa,kappap = np.zeros((2,argv['n_serial'],argv['n_parallel'],n_dir,n_dir))
+
+    Master = sp.csc_matrix((np.arange(len(mesh['im']))+1,(mesh['im'],mesh['jm'])),shape=(n_elems,n_elems),dtype=np.float64)
+    conversion = np.asarray(Master.data-1,np.int) 
+    inner = InnerSolver(Master,conversion,Gm,D,mfp,argv)
+
+    J = np.zeros((n_elems,dim,n_dir))
+
+    DeltaT_old = DeltaT.copy()
+    while kk < argv['max_bte_iter'] and error > argv['max_bte_error']:
+
+        DeltaTp = np.zeros_like(DeltaT)
+        TBp = np.zeros_like(TB)
+        Jp = np.zeros_like(J)
+
+        RHS = -np.einsum('cd,nc->ncd',TB,Gbm2) if len(mesh['db']) > 0 else  np.zeros((argv['n_parallel'],0,n_dir)) 
+
+        for n,q in enumerate(argv['rr']):
+
+           R = P[n].copy()
+           np.add.at(R,mesh['eb'],RHS[n])
+
+           for m in range(argv['n_serial']):
+
+                 if not mat['active'][m,q]: continue
+
+                 X = inner.solve(m,n,DeltaT,R)
+
+                 kappap[m,q] = np.einsum('ci,cj->ij',kappa_mask,X)
+
+                 DeltaTp += X*mat['tc'][m,q]
+
+                 if len(mesh['eb']) > 0:
+                  TBp -= X[mesh['eb']]*GG[m,q][:,np.newaxis]
+
+                 Jp += np.einsum('cd,j->cjd',X,sigma[m,q,0:dim])*1e-18
+
+        DeltaT_old = DeltaT.copy()
+        comm.Barrier()
+
+        comm.Allreduce([DeltaTp,MPI.DOUBLE],[DeltaT,MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([Jp,MPI.DOUBLE],[J,MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([kappap,MPI.DOUBLE],[kappa,MPI.DOUBLE],op=MPI.SUM)
+        comm.Allreduce([TBp,MPI.DOUBLE],[TB,MPI.DOUBLE],op=MPI.SUM)
+        kappa_totp = np.einsum('mqi,mqij,ij->ij',sigma[:,argv['rr']][:,:,directions],kappa[:,argv['rr']],scale)
+        comm.Allreduce([kappa_totp,MPI.DOUBLE],[kappa_tot,MPI.DOUBLE],op=MPI.SUM)
+
+        print_iteration_stats(argv,inner)
+
+        kk +=1
+        error = np.linalg.norm(kappa_old-kappa_tot)/np.linalg.norm(kappa_tot)
+        kappa_old = kappa_tot.copy()
+        kappa_vec.append(kappa_tot.copy())
+        if argv['verbose'] and comm.rank == 0:   
+         print('{0:8d}'.format(kk) + ''.join([' {0:12.4E}'.format(k) for k in np.diag(kappa_tot)]) + ' {0:14.4E}'.format(error),flush=True)
+
+    if argv['verbose'] and comm.rank == 0:
+      print(colored(' -----------------------------------------------------------','green'),flush=True)
+
+    d = directions.index(int(mesh['meta'][-1]))
+    output =  {'kappa':[k[d,d] for k in kappa_vec],'temperature':DeltaT[:,d],'flux':J[:,:,d],\
+               'kappa_mode':kappa[:,:,d,d]-np.dot(kappa_mask[:,d],DeltaT_old[:,d]),\
+               'kappa_tensor':kappa_tot,'temperature_tensor':DeltaT.T,'flux_tensor':J}
+
+    return output
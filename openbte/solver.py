@@ -14,6 +14,7 @@ import scipy
 from .solve_mfp import *
 from .solve_rta import *
 from .solve_full import *
+from .inner_solver import *
 import pkg_resources  
 
 comm = MPI.COMM_WORLD
@@ -23,6 +24,7 @@ class Solver(object):
   def __init__(self,**argv):
 
         #COMMON OPTIONS------------
+        options = dict(argv)
         self.data = argv
         self.tt = np.float64
         self.state = {}
@@ -30,6 +32,9 @@ class Solver(object):
         #self.umfpack = argv.setdefault('umfpack',False)
         self.error_multiscale_fourier = argv.setdefault('multiscale_error_fourier',5e-2)
         self.error_multiscale_ballistic = argv.setdefault('multiscale_error_ballistic',1e-2)
+        self.multiscale_refresh = argv.setdefault('multiscale_refresh',None)
+        self.fourier_warm_start = argv.setdefault('fourier_warm_start',False)
+        self.fourier_reuse_tol = argv.setdefault('fourier_reuse_tol',None)
         self.bundle = argv.setdefault('bundle',False)
         self.verbose = argv.setdefault('verbose',True)
 
@@ -38,6 +43,22 @@ class Solver(object):
         self.boost = argv.setdefault('boost',1.0)
         self.relaxation_factor = argv.setdefault('alpha',1.0)
         self.keep_lu = argv.setdefault('keep_lu',True)
+        self.inner_solver = argv.setdefault('inner_solver','lu')
+        self.transpose_lu = argv.setdefault('transpose_lu',True)
+        self.lu_memory = argv.setdefault('lu_memory',None)
+        self.lu_eviction = argv.setdefault('lu_eviction','lru')
+        self.lu_store = argv.setdefault('lu_store',None)
+        self.lu_precision = argv.setdefault('lu_precision','double')
+        self.lu_backend = argv.setdefault('lu_backend','superlu')
+        self.tensor = argv.setdefault('tensor',False)
+        self.bin_tol = argv.setdefault('bin_tol',0)
+        self.freeze_tol = argv.setdefault('freeze_tol',None)
+        self.panel_size = argv.setdefault('panel_size',0)
+        self.anderson_depth = argv.setdefault('anderson_depth',0)
+        self.outer_solver = argv.setdefault('outer_solver','picard')
+        self.dsa = argv.setdefault('dsa',False)
+        self.angular_coarsening = argv.setdefault('angular_coarsening',0)
+        self.coarse_geometry = argv.setdefault('coarse_geometry',None)
         self.only_fourier = argv.setdefault('only_fourier',False)
         self.max_bte_iter = argv.setdefault('max_bte_iter',10)
         self.min_bte_iter = argv.setdefault('min_bte_iter',20)
@@ -89,6 +110,7 @@ class Solver(object):
            names = {0:'dummy'} #this is when we read it from within the script
       
         self.mat = {}
+        self.dropped = np.zeros(2)
         for key,value in names.items():    
          if comm.rank == 0:   
           #data = argv['material'].data if 'material' in argv.keys() else dd.io.load(value)
@@ -99,8 +121,18 @@ class Solver(object):
             data = load_data(value)  
         
           data['kappa'] = data['kappa'][0:self.dim,0:self.dim] 
+          #all bins are active unless they are skipped below
+          if 'tc' in data.keys(): data['active'] = np.ones(np.shape(data['tc']),dtype=np.int64)
+          if self.verbose and self.bin_tol > 0 and not ('sigma' in data.keys() and np.ndim(data['tc']) == 2):
+           print(colored('  WARNING: bin_tol is only used with (MFP,direction) materials','red'),flush=True)
           if data['model'][0] == 10 : #full
            data['B'] = np.einsum('i,ij->ij',data['scale'],data['B'].T + data['B'])
+          elif 'sigma' in data.keys() and np.ndim(data['tc']) == 2:
+           #skip empty and negligible bins; their heat capacity goes to the active ones
+           active,self.dropped = get_active_bins(data['tc'],data['sigma'],data['mfp_sampled'],self.bin_tol)
+           data['tc'] = np.where(active,data['tc'],0)*data['tc'].sum()/data['tc'][active].sum()
+           data['sigma'] = np.einsum('mqi,mq->mqi',data['sigma'],active)
+           data['active'] = np.array(active,dtype=np.int64)
          else: data = None
 
          self.mat.update({key:create_shared_memory_dict(data)})
@@ -136,8 +168,24 @@ class Solver(object):
                 print(colored(' -----------------------------------------------------------','green'),flush=True)
                 print(" ",flush=True)
 
+        #full tensor: one applied gradient per axis (rta model)
+        if self.tensor:
+          unsupported = [key for key,value in [('multiscale',self.multiscale),('freeze_tol',self.freeze_tol is not None),\
+                        ('anderson_depth',self.anderson_depth > 0),('outer_solver',self.outer_solver != 'picard'),\
+                        ('dsa',self.dsa),('angular_coarsening',self.angular_coarsening > 0),('panel_size',self.panel_size > 0),\
+                        ('inner_solver',self.inner_solver != 'lu'),('save_state',self.save_state),('load_state',self.load_state),\
+                        ('coarse_geometry',self.coarse_geometry is not None)] if value]
+          if not 'kappa_mask_tensor' in self.mesh.keys(): unsupported.append('geometry without tensor=True')
+          elif not int(self.mesh['meta'][-1]) in get_tensor_directions(self.mesh): unsupported.append('non-periodic applied gradient')
+          if not self.model[0:3] == 'rta': unsupported.append('model ' + self.model)
+          if len(unsupported) > 0:
+           self.tensor = False
+           if comm.rank == 0 and self.verbose:
+            print(colored('  WARNING: tensor is not available with ' + ', '.join(unsupported) + '; solving the applied gradient only','red'),flush=True)
+
         if comm.rank == 0:
           data = self.solve_fourier(self.elem_kappa_map)
+          if self.tensor: data.update(self.solve_fourier_tensor(self.elem_kappa_map))
 
           variables = {0:{'name':'Temperature Fourier','units':'K','data':data['temperature_fourier'],'increment':-self.mesh['applied_gradient']},\
                        1:{'name':'Flux Fourier'       ,'units':'W/m/m','data':data['flux_fourier'],'increment':[0,0,0]}}
@@ -153,6 +201,15 @@ class Solver(object):
          #-------SET Parallel info----------------------------------------------
          block =  self.n_parallel//comm.size
          self.rr = range(block*comm.rank,self.n_parallel) if comm.rank == comm.size-1 else range(block*comm.rank,block*(comm.rank+1))
+         if argv.setdefault('transpose_lu',True) and comm.size > 1 and not self.model == 'full':
+           self.rr = get_paired_partition(self.mat[0]['VMFP'],comm.size,comm.rank)
+
+         #-------WARM START----------------------------------------------------
+         if self.load_state and self.model[0:3] in ['rta','mfp','Gra']:
+            argv['initial_guess'] = self.restart_guess()
+
+         elif self.coarse_geometry is not None and self.model[0:3] in ['rta','mfp','Gra']:
+            argv['initial_guess'] = self.coarse_guess(options)
 
          #-------SOLVE BTE------i
          argv['n_elems'] = len(self.mesh['elems'])
@@ -171,6 +228,10 @@ class Solver(object):
             argv['n_serial'] = self.n_serial
             data = solve_mfp(**argv) 
 
+         elif self.model[0:3] == 'rta' and self.tensor:
+            argv['n_serial'] = self.n_serial
+            data = solve_rta_tensor(**argv) 
+
          elif self.model[0:3] == 'rta':
             argv['n_serial'] = self.n_serial
             data = solve_rta(**argv) 
@@ -198,6 +259,9 @@ class Solver(object):
 
            #self.state.update({'kappa':data['kappa_vec']})
            self.state.update(data)
+           self.state.update({'centroids':self.mesh['centroids']})
+           if len(self.mesh['db']) > 0:
+            self.state.update({'boundary_centroids':self.mesh['side_centroids'][np.asarray(self.mesh['sb'],dtype=int)]})
 
           if argv.setdefault('save',True):
            #if self.bundle:
@@ -213,6 +277,58 @@ class Solver(object):
            print(' ',flush=True)  
 
 
+  def restart_guess(self):
+
+      #restart from a previous run; load_state is True (the checkpoint of save_state) or the
+      #name of a checkpoint or Solver output. The fields are remapped when the mesh differs.
+      if comm.rank == 0:
+        name = self.load_state if isinstance(self.load_state,str) else 'state'
+        data = load_checkpoint(name,self.mesh)
+        if data is None:
+          data = {}
+          if self.verbose: print(colored('  Restart:                                 ','green') + 'no usable data in ' + name + '.npz',flush=True)
+        elif self.verbose:
+          print(colored('  Restart Iterations:                      ','green') + str(len(data['kappa'])-1),flush=True)
+      else: data = None
+
+      return create_shared_memory_dict(data)
+
+  def coarse_guess(self,options):
+
+      #BTE solved on a coarser mesh of the same geometry (coarse_geometry: the data of
+      #Geometry, the name of its file, or True for the geometry_coarse file written by
+      #Geometry with coarse_step), then remapped onto this mesh through the centroids
+      if comm.rank == 0:
+        name = 'geometry_coarse' if self.coarse_geometry is True else self.coarse_geometry
+        geometry = load_data(name) if isinstance(name,str) else name
+        #the coarse mesh must describe the same domain
+        valid = isinstance(geometry,dict) and int(geometry['meta'][2]) == self.dim and \
+                int(geometry['meta'][-1]) == int(self.mesh['meta'][-1]) and \
+                np.allclose(geometry['size'],self.mesh['size'])
+        if not valid and self.verbose:
+          print(colored('  WARNING: coarse_geometry does not match the size, dimension and applied gradient of the geometry; it is not used','red'),flush=True)
+      else: geometry = None; valid = None
+      if not comm.bcast(valid,root=0): return create_shared_memory_dict({} if comm.rank == 0 else None)
+
+      coarse = Solver(**dict(options,geometry=geometry,coarse_geometry=None,save=False,verbose=False,\
+                             save_state=False,load_state=False))
+
+      if comm.rank == 0:
+        mesh = coarse.mesh
+        data = {'temperature':remap(mesh['centroids'],self.mesh['centroids'],coarse.state['temperature'],self.dim+1)}
+        if len(self.mesh['db']) > 0:
+          TB = np.asarray(coarse.state['TB'])
+          data['TB'] = remap(mesh['side_centroids'][np.asarray(mesh['sb'],dtype=int)],\
+                             self.mesh['side_centroids'][np.asarray(self.mesh['sb'],dtype=int)],TB.T,self.dim+1).T
+        if self.verbose:
+          print(colored('  Coarse Mesh Elements:                    ','green') + str(len(mesh['elems'])),flush=True)
+          print(colored('  Coarse Mesh Kappa [W/m/K]:               ','green') + str(round(coarse.state['kappa'][-1],4)),flush=True)
+          print(colored('  Coarse Mesh BTE Iterations:              ','green') + str(len(coarse.state['kappa'])-1),flush=True)
+          print(' ',flush=True)
+      else: data = None
+
+      return create_shared_memory_dict(data)
+
   def mpi_info(self):
 
           print(colored('  vCPUs:                                   ','green') + str(comm.size),flush=True)
@@ -233,12 +349,31 @@ class Solver(object):
           print(colored('  Multiscale:                              ','green')+ str(self.multiscale),flush=True)
           print(colored('  Relaxation:                              ','green')+ str(self.relaxation_factor),flush=True)
           print(colored('  Keep Lu:                                 ','green')+ str(self.keep_lu),flush=True)
+          print(colored('  Inner Solver:                            ','green')+ str(self.inner_solver),flush=True)
+          print(colored('  Transpose LU:                            ','green')+ str(self.transpose_lu),flush=True)
+          print(colored('  LU Memory [MB]:                          ','green')+ str(self.lu_memory),flush=True)
+          print(colored('  LU Eviction:                             ','green')+ str(self.lu_eviction),flush=True)
+          print(colored('  LU Store:                                ','green')+ str(self.lu_store),flush=True)
+          print(colored('  LU Precision:                            ','green')+ str(self.lu_precision),flush=True)
+          print(colored('  LU Backend:                              ','green')+ str(self.lu_backend),flush=True)
+          print(colored('  Tensor:                                  ','green')+ str(self.tensor),flush=True)
+          print(colored('  Bin Tolerance:                           ','green')+ str(self.bin_tol),flush=True)
+          print(colored('  Freeze Tolerance:                        ','green')+ str(self.freeze_tol),flush=True)
+          print(colored('  Panel Size:                              ','green')+ str(self.panel_size),flush=True)
+          print(colored('  Anderson Depth:                          ','green')+ str(self.anderson_depth),flush=True)
+          print(colored('  Outer Solver:                            ','green')+ str(self.outer_solver),flush=True)
+          print(colored('  DSA:                                     ','green')+ str(self.dsa),flush=True)
+          print(colored('  Angular Coarsening:                      ','green')+ str(self.angular_coarsening),flush=True)
+          print(colored('  Coarse Geometry:                         ','green')+ str(self.coarse_geometry is not None),flush=True)
           #print(colored('  Use umfpack                              ','green')+ str(self.umfpack),flush=True)
           #print(colored('  Deviational                              ','green')+ str(self.deviational),flush=True)
           print(colored('  Load State                               ','green')+ str(self.load_state),flush=True)
           print(colored('  Save State                               ','green')+ str(self.save_state),flush=True)
           print(colored('  Multiscale Error (Fourier):              ','green')+ str(self.error_multiscale_fourier),flush=True)
           print(colored('  Multiscale Error (Ballistic):            ','green')+ str(self.error_multiscale_ballistic),flush=True)
+          print(colored('  Multiscale Refresh:                      ','green')+ str(self.multiscale_refresh),flush=True)
+          print(colored('  Fourier Warm Start:                      ','green')+ str(self.fourier_warm_start),flush=True)
+          print(colored('  Fourier Reuse Tolerance:                 ','green')+ str(self.fourier_reuse_tol),flush=True)
           print(colored('  Only Fourier:                            ','green')+ str(self.only_fourier),flush=True)
           print(colored('  Max Fourier Error:                       ','green')+ '%.1E' % (self.max_fourier_error),flush=True)
           print(colored('  Max Fourier Iter:                        ','green')+ str(self.max_fourier_iter),flush=True)
@@ -252,6 +387,8 @@ class Solver(object):
   def mfp_info(self):
           print(colored('  Number of MFP:                           ','green')+ str(self.n_serial),flush=True)
           print(colored('  Number of Solid Angles:                  ','green')+ str(self.n_parallel),flush=True)
+          print(colored('  Active Bins:                             ','green')+ str(int(self.mat[0]['active'].sum())) + '/' + str(self.mat[0]['active'].size),flush=True)
+          print(colored('  Dropped Kappa/Heat Capacity Share [%]:   ','green')+ str(round(self.dropped[0]*100,4)) + '/' + str(round(self.dropped[1]*100,4)),flush=True)
 
   def bulk_info(self):
 
@@ -371,63 +508,98 @@ class Solver(object):
 
   
 
-  def compute_secondary_flux(self,temp,kappa):
-
-   #if not np.isscalar(kappa):
-   #  kappa = kappa[0,0]
-
-   diff_temp = []
-   for i in self.mesh['side_per_elem']:
-       diff_temp.append(i*[0])
-
-   a = time.time()
-   for ll in self.mesh['active_sides'] :
-    elems = self.mesh['side_elem_map_vec'][ll]
-    kc1 = elems[0]
-    c1 = self.mesh['centroids'][kc1]
-
-    ind1 = list(self.mesh['elem_side_map_vec'][kc1]).index(ll)
-    if not ll in self.mesh['boundary_sides']: 
-     kc2 = elems[1]
-     ind2 = list(self.mesh['elem_side_map_vec'][kc2]).index(ll)
-     temp_1 = temp[kc1]
-     temp_2 = temp[kc2]
-
-     if ll in self.mesh['periodic_sides']:
-      temp_2 += self.mesh['periodic_side_values'][list(self.mesh['periodic_sides']).index(ll)]
-
-     diff_t = temp_2 - temp_1
-     diff_temp[kc1][ind1]  = diff_t
-     diff_temp[kc2][ind2]  = -diff_t
-
-   gradT = np.zeros((self.n_elems,self.dim))
-   for k,dt in enumerate(diff_temp):
-    gradT[k] = np.einsum('js,s->j',self.mesh['weigths'][k,:,:self.mesh['side_per_elem'][k]],np.array(dt))
-
-   #-----------------------------------------------------
-   F_ave = np.zeros((len(self.mesh['sides']),self.dim))
-   for ll in self.mesh['active_sides']:
-      (i,j) = self.mesh['side_elem_map_vec'][ll]
-      if not i==j:
-       kappa_loc = self.get_kappa(i,j,ll,kappa)
-       w = self.mesh['interp_weigths'][ll]
-       F_ave[ll] = w*gradT[i] + (1.0-w)*gradT[j]
-    
-
-   C = np.zeros(self.n_elems)
-   for ll in self.mesh['active_sides']:
-    (i,j) = self.mesh['side_elem_map_vec'][ll]
-    if not i==j:
-      kappa_loc = self.get_kappa(i,j,ll,kappa)
-      area = self.mesh['areas'][ll]   
-      (dummy,v_non_orth) = self.get_decomposed_directions(ll,rot=kappa_loc)
-      tmp = np.dot(F_ave[ll],v_non_orth)*area
-      C[i] += tmp/self.mesh['volumes'][i]
-      C[j] -= tmp/self.mesh['volumes'][j]
-
-
-   return C,gradT
+  def compute_secondary_flux(self,temp,K):
+
+   #K: non-orthogonal flux operator (get_secondary_flux_operator)
+   gradT = compute_gradient(temp,self.mesh)
+
+   return K.dot(gradT.ravel()),gradT
+
+  def get_face_kappa(self,kappa):
+
+   #inner sides, their elements and the face conductances (get_kappa), for all the sides at once
+   mesh = self.mesh
+   sides = np.asarray(mesh['active_sides'],dtype=int)
+   i,j = np.asarray(mesh['side_elem_map_vec'],dtype=int)[sides].T
+   keep = i != j
+   sides,i,j = sides[keep],i[keep],j[keep]
+
+   normal = np.array(mesh['face_normals'][sides,0:self.dim])
+   w      = mesh['interp_weigths'][sides]
+   kappa_i = np.array(kappa,dtype=np.float64)[i]
+   kappa_j = np.array(kappa,dtype=np.float64)[j]
+   n_row,n_col = normal[:,np.newaxis,:],normal[:,:,np.newaxis]
+   ki = np.matmul(n_row,np.matmul(kappa_i,n_col))[:,0,0]
+   kj = np.matmul(n_row,np.matmul(kappa_j,n_col))[:,0,0]
+   kappa_loc = kj[:,np.newaxis,np.newaxis]*kappa_i/(ki*(1-w) + kj*w)[:,np.newaxis,np.newaxis]
+
+   return sides,i,j,kappa_loc
+
+  def get_secondary_flux_operator(self,kappa):
+
+   #Non-orthogonal part of the fluxes (get_decomposed_directions), from the gradient
+   #interpolated on the sides: C = K*gradT, with gradT of shape (n_elems,dim) flattened.
+   mesh = self.mesh
+   sides,i,j,kappa_loc = self.get_face_kappa(kappa)
+   normal = np.array(mesh['face_normals'][sides,0:self.dim])
+   dist   = np.array(mesh['dists'][sides,0:self.dim])
+   rot_normal = np.matmul(kappa_loc,normal[:,:,np.newaxis])[:,:,0]
+   v_orth = np.einsum('sj,sj->s',normal,rot_normal)/np.einsum('sj,sj->s',normal,dist)
+   v_non_orth = (rot_normal - dist*v_orth[:,np.newaxis])*mesh['areas'][sides][:,np.newaxis]
+   w  = mesh['interp_weigths'][sides][:,np.newaxis]
+   vi = 1/mesh['volumes'][i][:,np.newaxis]
+   vj = 1/mesh['volumes'][j][:,np.newaxis]
+   ci = (i[:,np.newaxis]*self.dim + np.arange(self.dim)).ravel()
+   cj = (j[:,np.newaxis]*self.dim + np.arange(self.dim)).ravel()
+   ri,rj = np.repeat(i,self.dim),np.repeat(j,self.dim)
+   data = np.concatenate(((w*v_non_orth*vi).ravel(),((1-w)*v_non_orth*vi).ravel(),\
+                          -(w*v_non_orth*vj).ravel(),-((1-w)*v_non_orth*vj).ravel()))
+
+   return sp.csr_matrix((data,(np.concatenate((ri,ri,rj,rj)),np.concatenate((ci,cj,ci,cj)))),shape=(self.n_elems,self.n_elems*self.dim))
+
+  def get_fourier_operator(self,kappa):
+
+   #Diffusion operator (orthogonal part of the fluxes) and periodic RHS, assembled over all
+   #the sides at once. The per-side products are batched through matmul, which calls the same
+   #BLAS routines as np.dot, and the contributions are accumulated with np.add.at in the
+   #order of a side-by-side assembly, so that each entry sums the same terms in the same order.
+   mesh = self.mesh
+   sides,i,j,kappa_loc = self.get_face_kappa(kappa)
+
+   #orthogonal coefficients (get_decomposed_directions)
+   normal = np.array(mesh['face_normals'][sides,0:self.dim])
+   dist   = np.array(mesh['dists'][sides,0:self.dim])
+   n_row,n_col = normal[:,np.newaxis,:],normal[:,:,np.newaxis]
+   v_orth = np.matmul(n_row,np.matmul(kappa_loc,n_col))[:,0,0]/np.matmul(n_row,dist[:,:,np.newaxis])[:,0,0]
+
+   area = mesh['areas'][sides]
+   ai = v_orth/mesh['volumes'][i]*area
+   aj = v_orth/mesh['volumes'][j]*area
+
+   #matrix: (i,i),(i,j),(j,j),(j,i) for each side, in this order. Within a column, the
+   #entries are stored in the order they first appear, as from a dok_matrix.
+   rows = np.stack((i,i,j,j),axis=1).ravel()
+   cols = np.stack((i,j,j,i),axis=1).ravel()
+   keys,first,inverse = np.unique(cols*self.n_elems + rows,return_index=True,return_inverse=True)
+   data = np.zeros(len(keys))
+   np.add.at(data,inverse.ravel(),np.stack((ai,-ai,aj,-aj),axis=1).ravel())
+   order = np.argsort(first)
+   order = order[np.argsort(keys[order]//self.n_elems,kind='stable')]
+   order = order[data[order] != 0]
+   indptr = np.concatenate(([0],np.cumsum(np.bincount(keys[order]//self.n_elems,minlength=self.n_elems))))
+   F = sp.csc_matrix((data[order],keys[order] % self.n_elems,indptr),shape=(self.n_elems,self.n_elems))
+
+   #periodic RHS (first occurrence of a side in periodic_sides)
+   periodic = np.asarray(mesh['periodic_sides'],dtype=int)
+   index = -np.ones(len(mesh['side_elem_map_vec']),dtype=int)
+   index[periodic[::-1]] = np.arange(len(periodic))[::-1]
+   p = np.nonzero(index[sides] >= 0)[0]
+   values = np.asarray(mesh['periodic_side_values'])[index[sides[p]]]
+   B = np.zeros(self.n_elems)
+   np.add.at(B,np.stack((i[p],j[p]),axis=1).ravel(),\
+             np.stack((values*v_orth[p]/mesh['volumes'][i[p]]*area[p],-(values*v_orth[p]/mesh['volumes'][j[p]]*area[p])),axis=1).ravel())
 
+   return F,B
 
   def solve_fourier(self,kappa,**argv):
 
@@ -437,29 +609,8 @@ class Solver(object):
    if kappa.ndim == 2:
       kappa = np.repeat(np.array([np.diag(np.diag(kappa))]),self.n_elems,axis=0)
 
-   F = sp.dok_matrix((self.n_elems,self.n_elems))
-   B = np.zeros(self.n_elems)
-   for ll in self.mesh['active_sides']:
-
-      area = self.mesh['areas'][ll] 
-      (i,j) = self.mesh['side_elem_map_vec'][ll]
-      vi = self.mesh['volumes'][i]
-      vj = self.mesh['volumes'][j]
-      kappa_loc = self.get_kappa(i,j,ll,kappa)
-      #kappa_loc = np.eye(2)*kappa_loc[0,0] 
-
-      if not i == j:
-
-       (v_orth,dummy) = self.get_decomposed_directions(ll,rot=kappa_loc)
-       F[i,i] += v_orth/vi*area
-       F[i,j] -= v_orth/vi*area
-       F[j,j] += v_orth/vj*area
-       F[j,i] -= v_orth/vj*area
-       if ll in self.mesh['periodic_sides']:    
-        kk = list(self.mesh['periodic_sides']).index(ll)   
-        B[i] += self.mesh['periodic_side_values'][kk]*v_orth/vi*area
-        B[j] -= self.mesh['periodic_side_values'][kk]*v_orth/vj*area
-   
+   F,B = self.get_fourier_operator(kappa)
+   K = self.get_secondary_flux_operator(kappa)
     
    ##rescaleand fix one point to 0
    #scale = 1/F.max(axis=0).toarray()[0]
@@ -489,7 +640,7 @@ class Solver(object):
         kappa_old = kappa_eff
         n_iter +=1
 
-        C,grad = self.compute_secondary_flux(temp,kappa)
+        C,grad = self.compute_secondary_flux(temp,K)
 
 
    flux = -np.einsum('cij,cj->ci',kappa,grad)
@@ -500,6 +651,21 @@ class Solver(object):
 
 
 
+  def solve_fourier_tensor(self,kappa):
+
+   #Fourier temperatures for a unit gradient along each axis with periodic flux sides
+   mesh,kappa_factor = self.mesh,self.kappa_factor
+   temp = []; kappa_eff = []
+   for d in get_tensor_directions(mesh):
+      self.mesh = get_direction_mesh(mesh,d)
+      self.kappa_factor = self.mesh['meta'][1]
+      data = self.solve_fourier(kappa)
+      temp.append(data['temperature_fourier']); kappa_eff.append(data['meta'][0])
+   self.mesh,self.kappa_factor = mesh,kappa_factor
+
+   return {'temperature_fourier_tensor':np.array(temp),'kappa_fourier_tensor':np.array(kappa_eff)}
+
+
   def compute_diffusive_thermal_conductivity(self,temp,gradT,kappa):
 
    kappa_eff = 0
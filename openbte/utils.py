@@ -12,6 +12,8 @@ import io,zipfile
 import math
 import pickle
 import gzip
+from scipy.spatial import cKDTree
+import scipy.sparse as sp
 
 os.environ['H5PY_DEFAULT_READONLY']='1'
 
@@ -559,3 +561,192 @@ def create_shared_memory(varss):
          exec('self.' + var + '=output')
 
 
+
+
+def get_tensor_directions(mesh):
+
+    #axes of the unit gradients of a geometry built with tensor=True
+    if 'tensor_directions' in mesh.keys(): return [int(d) for d in mesh['tensor_directions']]
+
+    return list(range(int(mesh['meta'][2])))
+
+
+def get_direction_mesh(mesh,d):
+
+    #view of a geometry built with tensor=True for a unit gradient along axis d
+    view = dict(mesh)
+    k = get_tensor_directions(mesh).index(d)
+    a,b = mesh['pp_tensor_offset'][k:k+2]
+    view['pp'] = mesh['pp_tensor'][a:b]
+    a,b = mesh['flux_sides_tensor_offset'][k:k+2]
+    view['flux_sides'] = mesh['flux_sides_tensor'][a:b]
+    view['kappa_mask'] = mesh['kappa_mask_tensor'][k]
+    view['periodic_side_values'] = mesh['periodic_side_values_tensor'][k]
+    view['applied_gradient'] = np.eye(3)[d]
+    view['meta'] = mesh['meta'].copy()
+    view['meta'][1] = mesh['kappa_factor_tensor'][k]
+    view['meta'][-1] = d
+
+    return view
+
+
+def get_active_bins(tc,sigma,mfp,tol=0):
+
+    #(MFP,direction) bins carrying more than tol of the heat capacity or of the
+    #(bulk) thermal conductivity. Also returns the dropped shares, which bound the error.
+    share_c = np.abs(tc)/np.abs(tc).sum()
+    share_k = np.einsum('mq,m->mq',np.linalg.norm(sigma,axis=2),mfp)
+    share_k /= share_k.sum()
+    active = np.logical_or(share_c > tol,share_k > tol)
+
+    return active,np.array([share_k[~active].sum(),share_c[~active].sum()])
+
+
+def remap(source,target,values,k=None):
+
+    #Inverse-distance interpolation of values (first axis: the points source) onto the points
+    #target, from the k nearest source points (default: dim+1), found with a k-d tree.
+    #A target point that coincides with a source point takes its value.
+    source = np.asarray(source); target = np.asarray(target); values = np.asarray(values)
+    k = min([source.shape[1]+1 if k == None else k,len(source)])
+    d,idx = cKDTree(source).query(target,k=k)
+    d = d.reshape((len(target),k)); idx = idx.reshape((len(target),k))
+
+    with np.errstate(divide='ignore'):
+      w = 1/d
+    exact = np.isinf(w).any(axis=1)
+    w[exact] = np.isinf(w[exact])
+    w /= w.sum(axis=1)[:,np.newaxis]
+
+    return np.einsum('tk,tk...->t...',w,values[idx])
+
+
+def save_checkpoint(argv,DeltaT,TB,kappa_vec):
+
+    #restart data of the BTE loop (save_state: True, or the name of the file), with the
+    #same keys as the output of Solver
+    if comm.rank == 0:
+      mesh = argv['mesh']
+      data = {'temperature':DeltaT,'TB':TB,'kappa':kappa_vec,'centroids':mesh['centroids']}
+      if len(mesh['db']) > 0:
+        data['boundary_centroids'] = mesh['side_centroids'][np.asarray(mesh['sb'],dtype=int)]
+      save_data(argv['save_state'] if isinstance(argv['save_state'],str) else 'state',data)
+
+
+def load_checkpoint(name,mesh):
+
+    #Fields of a previous run (a checkpoint of save_state or the output of Solver), remapped
+    #onto mesh through the centroids when the meshes differ. None if they cannot be used.
+    data = load_data(name)
+    if not isinstance(data,dict) or not 'temperature' in data.keys(): return None
+
+    output = {'temperature':np.asarray(data['temperature']),\
+              'TB':np.asarray(data['TB']) if 'TB' in data.keys() else np.zeros(0),\
+              'kappa':np.asarray(data['kappa'])}
+    if len(output['temperature']) == len(mesh['elems']) and \
+       (not 'centroids' in data.keys() or np.allclose(data['centroids'],mesh['centroids'])):
+       return output
+
+    if not 'centroids' in data.keys(): return None
+    dim = int(mesh['meta'][2])
+    output['temperature'] = remap(data['centroids'],mesh['centroids'],output['temperature'],dim+1)
+    if output['TB'].size > 0 and len(mesh['db']) > 0 and 'boundary_centroids' in data.keys():
+       output['TB'] = remap(data['boundary_centroids'],mesh['side_centroids'][np.asarray(mesh['sb'],dtype=int)],output['TB'].T,dim+1).T
+    else: output['TB'] = np.zeros(0)
+
+    return output
+
+
+def compute_mesh_operators(mesh):
+
+    #Triplets (rows, columns, values) of the sparse operators of the Fourier corrections:
+    # - grad: least-squares gradient, (n_elems*dim) x n_elems, so that the gradient is
+    #   grad*T + grad_periodic*periodic_side_values, reshaped to (n_elems,dim)
+    # - flux: non-orthogonal flux of a unit isotropic conductivity, n_elems x (n_elems*dim),
+    #   from the gradient interpolated on the sides
+    #Only integer and float arrays, so that they can be stored with the geometry.
+    dim = int(mesh['meta'][2])
+    n_elems = len(mesh['elems'])
+    sides = np.asarray(mesh['active_sides'],dtype=int)
+    kc1,kc2 = np.asarray(mesh['side_elem_map_vec'],dtype=int)[sides].T
+
+    #periodic index of each side (first occurrence in periodic_sides)
+    periodic = np.asarray(mesh['periodic_sides'],dtype=int)
+    index = -np.ones(len(mesh['side_elem_map_vec']),dtype=int)
+    index[periodic[::-1]] = np.arange(len(periodic))[::-1]
+
+    #gradient: each side contributes T[other]-T[elem](+-delta) to both its elements. A side
+    #with kc1 == kc2 has a single slot, where the second contribution (-delta) is the one that
+    #is kept, as in a side-by-side assembly; its temperature difference is zero.
+    #The slots follow elem_side_map_vec (boundary sides last), as the columns of weigths;
+    #n_non_boundary_side_per_elem counts all the sides of an element, as in compute_grad.
+    esm = np.asarray(mesh['elem_side_map_vec'],dtype=int)
+    n_side = np.asarray(mesh['n_non_boundary_side_per_elem'],dtype=int)
+    rows,cols,vals,prows,pcols,pvals = [],[],[],[],[],[]
+    for elem,other,sign in [(kc1,kc2,1),(kc2,kc1,-1)]:
+      slot = np.argmax(esm[elem] == sides[:,np.newaxis],axis=1)
+      ok = slot < n_side[elem]
+      if sign > 0: ok = np.logical_and(ok,kc1 != kc2)
+      e,o,s,p = elem[ok],other[ok],slot[ok],index[sides[ok]]
+      W = mesh['weigths'][e,:,s] #(sides,dim)
+      r = (e[:,np.newaxis]*dim + np.arange(dim)).ravel()
+      t = np.repeat(e != o,dim)
+      rows += [r[t],r[t]]
+      cols += [np.repeat(o,dim)[t],np.repeat(e,dim)[t]]
+      vals += [W.ravel()[t],-W.ravel()[t]]
+      q = np.repeat(p >= 0,dim)
+      prows.append(r[q]); pcols.append(np.repeat(p,dim)[q]); pvals.append(sign*W.ravel()[q])
+
+    #the flux is only exchanged between different elements
+    keep = kc1 != kc2
+    sides,kc1,kc2 = sides[keep],kc1[keep],kc2[keep]
+
+    #non-orthogonal flux: (w*grad_i + (1-w)*grad_j).v_non_orth, added to i and removed from j
+    normal = np.array(mesh['face_normals'][sides,0:dim])
+    dist   = np.array(mesh['dists'][sides,0:dim])
+    v_orth = 1/np.einsum('sj,sj->s',normal,dist)
+    v_non_orth = (normal - dist*v_orth[:,np.newaxis])*mesh['areas'][sides][:,np.newaxis]
+    w = mesh['interp_weigths'][sides][:,np.newaxis]
+    vi = 1/mesh['volumes'][kc1][:,np.newaxis]
+    vj = 1/mesh['volumes'][kc2][:,np.newaxis]
+    ci = (kc1[:,np.newaxis]*dim + np.arange(dim)).ravel()
+    cj = (kc2[:,np.newaxis]*dim + np.arange(dim)).ravel()
+    ri = np.repeat(kc1,dim); rj = np.repeat(kc2,dim)
+
+    return {'grad_i':np.concatenate(rows).astype(np.int64),\
+            'grad_j':np.concatenate(cols).astype(np.int64),\
+            'grad_v':np.concatenate(vals).astype(np.float64),\
+            'grad_periodic_i':np.concatenate(prows).astype(np.int64),\
+            'grad_periodic_j':np.concatenate(pcols).astype(np.int64),\
+            'grad_periodic_v':np.concatenate(pvals).astype(np.float64),\
+            'flux_i':np.concatenate((ri,ri,rj,rj)).astype(np.int64),\
+            'flux_j':np.concatenate((ci,cj,ci,cj)).astype(np.int64),\
+            'flux_v':np.concatenate(((w*v_non_orth*vi).ravel(),((1-w)*v_non_orth*vi).ravel(),\
+                                     -(w*v_non_orth*vj).ravel(),-((1-w)*v_non_orth*vj).ravel())).astype(np.float64)}
+
+
+def get_mesh_operators(mesh):
+
+    #Sparse gradient and non-orthogonal flux operators, from the triplets stored with the
+    #geometry or, for older geometries, computed here. They are kept in the mesh.
+    if not 'operators' in mesh.keys():
+      data = mesh if 'grad_i' in mesh.keys() else compute_mesh_operators(mesh)
+      dim = int(mesh['meta'][2])
+      n_elems = len(mesh['elems'])
+      mesh['operators'] = {\
+          'grad':sp.csr_matrix((data['grad_v'],(data['grad_i'],data['grad_j'])),shape=(n_elems*dim,n_elems)),\
+          'grad_periodic':sp.csr_matrix((data['grad_periodic_v'],(data['grad_periodic_i'],data['grad_periodic_j'])),\
+                                        shape=(n_elems*dim,len(mesh['periodic_sides']))),\
+          'flux':sp.csr_matrix((data['flux_v'],(data['flux_i'],data['flux_j'])),shape=(n_elems,n_elems*dim))}
+
+    return mesh['operators']
+
+
+def compute_gradient(temp,mesh):
+
+    #least-squares gradient of temp, (n_elems,dim)
+    op = get_mesh_operators(mesh)
+    grad = op['grad'].dot(temp)
+    if op['grad_periodic'].shape[1] > 0: grad += op['grad_periodic'].dot(mesh['periodic_side_values'])
+
+    return grad.reshape((len(mesh['elems']),-1))
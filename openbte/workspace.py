@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+import numpy as np
+
+
+class Workspace(object):
+
+  #Buffers of one rank, sized once from the mesh, that the per-bin updates of the
+  #BTE loop write into in place. The solution of each bin comes from the inner solver.
+
+  def __init__(self,n_elems,eb,dim,panel_size=0):
+
+      self.eb = np.asarray(eb,dtype=np.int64)
+      n_eb = len(self.eb)
+
+      #boundary scatter (an element can have several boundary sides): only the
+      #boundary elements are touched; sides are sorted by element and summed by segments
+      self.ueb,inverse = np.unique(self.eb,return_inverse=True)
+      self.order  = np.argsort(inverse,kind='stable')
+      self.starts = np.concatenate(([0],np.cumsum(np.bincount(inverse,minlength=len(self.ueb)))[:-1])).astype(np.int64)
+      self.RS = np.zeros(n_eb)
+      self.RB = np.zeros(len(self.ueb))
+      self.RU = np.zeros(len(self.ueb))
+
+      self.R  = np.zeros(n_elems)
+      self.T  = np.zeros(n_elems)
+      self.TB = np.zeros(n_eb)
+      self.J  = np.zeros((n_elems,dim))
+
+      self.panel = np.zeros((panel_size,n_elems)) if panel_size > 0 else None
+      self.bins  = []
+      self.k     = 0
+
+  def get_boundary(self,P,RHS):
+
+      #periodic + boundary terms
+      if len(self.eb) == 0: return P
+
+      np.copyto(self.R,P)
+      np.take(RHS,self.order,out=self.RS)
+      np.add.reduceat(self.RS,self.starts,out=self.RB)
+      np.take(self.R,self.ueb,out=self.RU)
+      self.RU += self.RB
+      np.put(self.R,self.ueb,self.RU)
+      return self.R
+
+  def get_bin(self,X,tc,GG,sigma):
+
+      #contributions of one bin; they stay in T, TB and J until the next call
+      np.multiply(X,tc,out=self.T)
+
+      if len(self.eb) > 0:
+         np.take(X,self.eb,out=self.TB)
+         self.TB *= GG
+         np.negative(self.TB,out=self.TB)
+
+      np.multiply(X[:,np.newaxis],sigma,out=self.J)
+      self.J *= 1e-18
+
+  def add_bin(self,X,tc,GG,sigma,DeltaTp,TBp,Jp):
+
+      self.get_bin(X,tc,GG,sigma)
+      DeltaTp += self.T
+      if len(self.eb) > 0: TBp += self.TB
+      Jp += self.J
+
+
+  #Panel---------------------------------------------------------------------
+  #Solutions of several bins are stored as rows of a panel; the reductions are then
+  #applied to the whole panel as matrix products instead of one bin at a time.
+
+  def push(self,X,m,q,kappa_bin):
+
+      #returns True when the panel is full
+      self.panel[self.k] = X
+      self.bins.append((m,q,kappa_bin))
+      self.k +=1
+      return self.k == len(self.panel)
+
+  def flush(self,kappa_mask,tc,GG,sigma,kappap,DeltaTp,TBp,Jp,rows=False):
+
+      #with rows, TBp has one row per MFP (non-thermalizing boundaries)
+      bins = self.bins
+      if self.k == 0: return bins
+
+      X = self.panel[:self.k]
+      m,q = np.array([b[:2] for b in bins],dtype=np.int64).T
+
+      kappap[m,q] = X.dot(kappa_mask)
+      DeltaTp += tc[m,q].dot(X)
+      Jp += X.T.dot(sigma[m,q])*1e-18
+      if len(self.eb) > 0:
+         XB = X[:,self.eb]*GG[m,q]
+         if rows:
+            np.subtract.at(TBp,m,XB)
+         else:
+            TBp -= XB.sum(axis=0)
+
+      self.k = 0
+      self.bins = []
+      return bins